@@ -68,24 +68,54 @@ def make_scaling(data_sources=None):
 
 
 class TimeseriesDataset(Dataset):
-  def __init__(self, netcdf_path, tile_size=128, sampling_mode='targets_only'):
+  """
+  Samples Sentinel-2 tiles from a time-series cube.
+
+  By default, every sample is a single date. With `sequence=True`, a sample is the
+  whole (T, C, H, W) stack of a window, read in one go. Dates can be subsampled
+  with `temporal_stride`, dates with less than `min_valid` non-NaN (i.e. not
+  cloud-masked) pixels in the window are dropped, and `sequence_length` evenly
+  subsamples longer sequences and zero-pads shorter ones to a fixed length.
+  Sequence samples are (img, valid, mask), where `valid` flags the non-padded dates
+  and the mask is the label of the last selected date. Batch them with `sequence_collate`.
+  """
+  def __init__(self, netcdf_path, tile_size=128, sampling_mode='targets_only',
+               sequence=False, sequence_length=None, temporal_stride=1, min_valid=0.0):
     self.data = xarray.open_dataset(netcdf_path, cache=False)
     self.sampling_mode = sampling_mode
+    self.sequence = sequence
+    self.sequence_length = sequence_length
+    self.temporal_stride = temporal_stride
+    self.min_valid = min_valid
 
     self.tile_size = tile_size
     self.T, self.H, self.W = len(self.data.time), len(self.data.y), len(self.data.x)
     self.H_tile = self.H // self.tile_size
     self.W_tile = self.W // self.tile_size
 
+    # For every time step, the last mask at or before it and the first mask at or after it (-1 if there is none)
+    time = self.data.time.values
+    mask_time = self.data.mask_time.values
+    is_before = mask_time[None, :] <= time[:, None]
+    is_after  = mask_time[None, :] >= time[:, None]
+    self.last_before = np.where(is_before.any(axis=1),
+                                len(mask_time) - 1 - np.argmax(is_before[:, ::-1], axis=1), -1)
+    self.first_after = np.where(is_after.any(axis=1), np.argmax(is_after, axis=1), -1)
+
     if self.sampling_mode == 'targets_only':
-      is_ever_positive = (self.data.Mask == 1).any('mask_time').squeeze('mask_band')
-      self.positive_points = np.argwhere(is_ever_positive.values)
+      is_ever_positive = (self.data.Mask == 1).any('mask_time').squeeze('mask_band').values
+      # Flat indices of the positive pixels, a fraction of the size of their (y, x) coordinates
+      index_dtype = np.int32 if is_ever_positive.size < 2**31 else np.int64
+      self.positive_pixels = np.flatnonzero(is_ever_positive).astype(index_dtype)
     elif self.sampling_mode == 'grid_nearest':
       self.T = len(self.data.mask_time)
       self.closest_sample = [np.argmin(np.abs(self.data.time.values - t))
                              for t in self.data.mask_time.values]
 
   def __getitem__(self, idx):
+    if self.sequence:
+      return self._get_sequence(idx)
+
     if self.sampling_mode == 'grid':
       t, inner_idx = divmod(idx, self.H_tile * self.W_tile)
       y_tile, x_tile = divmod(inner_idx, self.W_tile)
@@ -99,51 +129,117 @@ class TimeseriesDataset(Dataset):
       t = self.closest_sample[t_mask]
     elif self.sampling_mode == 'random':
       t  = int(torch.randint(0, self.T, ()))
-      y0 = int(torch.randint(0, self.H - self.tile_size, ()))
-      x0 = int(torch.randint(0, self.W - self.tile_size, ()))
+      y0, x0 = self._random_window()
     elif self.sampling_mode == 'targets_only':
       t  = int(torch.randint(0, self.T, ()))
-      point_idx = int(torch.randint(0, self.positive_points.shape[0], ()))
-      contained_y, contained_x = self.positive_points[point_idx]
-
-      y0 = max(0, min(self.H - self.tile_size,
-               contained_y - int(torch.randint(0, self.tile_size, ()))))
-      x0 = max(0, min(self.W - self.tile_size,
-                      contained_x - int(torch.randint(0, self.tile_size, ()))))
+      y0, x0 = self._positive_window()
     else:
       raise ValueError(f'Unsupported tiling mode: {self.sampling_mode!r}')
     y1 = y0 + self.tile_size
     x1 = x0 + self.tile_size
 
     tile = self.data.Sentinel2[t, :, y0:y1, x0:x1]
-    tile_date = self.data.time[t]
+    mask = self._label(t, y0, y1, x0, x1)
 
-    # Get mask
-    mask = 255 * np.ones([self.tile_size, self.tile_size], np.uint8)
+    tile = np.clip(np.nan_to_num(tile.values) / 10000, 0, 1)
+    return torch.from_numpy(tile), torch.from_numpy(mask)
+
+  def _get_sequence(self, idx):
+    if self.sampling_mode in ('grid', 'grid_nearest'):
+      y_tile, x_tile = divmod(idx, self.W_tile)
+      y0 = y_tile * self.tile_size
+      x0 = x_tile * self.tile_size
+    elif self.sampling_mode == 'random':
+      y0, x0 = self._random_window()
+    elif self.sampling_mode == 'targets_only':
+      y0, x0 = self._positive_window()
+    else:
+      raise ValueError(f'Unsupported tiling mode: {self.sampling_mode!r}')
+    y1 = y0 + self.tile_size
+    x1 = x0 + self.tile_size
 
-    is_before = self.data.mask_time <= tile_date
-    if np.any(is_before):
-      last_before = np.arange(len(is_before))[is_before][-1]
-      later_mask = self.data.Mask[last_before, 0, y0:y1, x0:x1]
-      mask = np.where(later_mask == 1, 1, mask)
+    dates = np.arange(0, len(self.data.time), self.temporal_stride)
+    # One strided hyperslab read for all dates of the window
+    stack = self.data.Sentinel2[::self.temporal_stride, :, y0:y1, x0:x1].values
+    if self.min_valid > 0:
+      valid_fraction = (~np.isnan(stack)).mean(axis=(1, 2, 3))
+      keep = valid_fraction >= self.min_valid
+      if not keep.any():
+        keep = valid_fraction == valid_fraction.max()
+      dates, stack = dates[keep], stack[keep]
+    if self.sequence_length and len(dates) > self.sequence_length:
+      keep = np.linspace(0, len(dates) - 1, self.sequence_length).round().astype(int)
+      dates, stack = dates[keep], stack[keep]
+
+    L = self.sequence_length or len(dates)
+    tile = np.zeros([L, *stack.shape[1:]], np.float32)
+    tile[:len(dates)] = np.clip(np.nan_to_num(stack) / 10000, 0, 1)
+    valid = np.zeros([L], bool)
+    valid[:len(dates)] = True
+    mask = self._label(dates[-1], y0, y1, x0, x1)
+    return torch.from_numpy(tile), torch.from_numpy(valid), torch.from_numpy(mask)
+
+  def _random_window(self):
+    y0 = int(torch.randint(0, self.H - self.tile_size, ()))
+    x0 = int(torch.randint(0, self.W - self.tile_size, ()))
+    return y0, x0
+
+  def _positive_window(self):
+    """
+    A window containing a positive pixel drawn uniformly (so larger objects are sampled
+    proportionally more often), placed at a random offset around it.
+    """
+    pixel = int(self.positive_pixels[int(torch.randint(0, len(self.positive_pixels), ()))])
+    contained_y, contained_x = divmod(pixel, self.W)
+
+    y0 = max(0, min(self.H - self.tile_size,
+             contained_y - int(torch.randint(0, self.tile_size, ()))))
+    x0 = max(0, min(self.W - self.tile_size,
+                    contained_x - int(torch.randint(0, self.tile_size, ()))))
+    return y0, x0
+
+  def _label(self, t, y0, y1, x0, x1):
+    mask = 255 * np.ones([self.tile_size, self.tile_size], np.uint8)
 
-    is_after  = self.data.mask_time >= tile_date
-    if np.any(is_after):
-      first_after = np.arange(len(is_after))[is_after][0]
-      later_mask = self.data.Mask[first_after, 0, y0:y1, x0:x1]
-      mask = np.where(later_mask == 0, 0, mask)
+    last_before = self.last_before[t]
+    if last_before >= 0:
+      earlier_mask = self.data.Mask[last_before, 0, y0:y1, x0:x1].values
+      mask[earlier_mask == 1] = 1
 
-    tile = np.clip(np.nan_to_num(tile.values) / 10000, 0, 1)
-    return torch.from_numpy(tile), torch.from_numpy(mask)
+    first_after = self.first_after[t]
+    if first_after >= 0:
+      later_mask = self.data.Mask[first_after, 0, y0:y1, x0:x1].values
+      mask[later_mask == 0] = 0
+    return mask
 
   def __len__(self):
+    if self.sequence:
+      return self.H_tile * self.W_tile
     return self.T * self.H_tile * self.W_tile
 
 
+def sequence_collate(batch):
+  """Batches (img, valid, mask) sequence samples of different lengths, padding to the longest one"""
+  imgs, valids, masks = zip(*batch)
+  L = max(len(img) for img in imgs)
+  img_batch = torch.zeros([len(imgs), L, *imgs[0].shape[1:]], dtype=imgs[0].dtype)
+  valid_batch = torch.zeros([len(imgs), L], dtype=torch.bool)
+  for i, (img, valid) in enumerate(zip(imgs, valids)):
+    img_batch[i, :len(img)] = img
+    valid_batch[i, :len(valid)] = valid
+  return img_batch, valid_batch, torch.stack(masks)
+
+
 def get_loader(scenes, batch_size, tile_size, sampling_mode, augment=False, augment_types=None, shuffle=False,
-        num_workers=0, data_sources=None, data_root=None):
-    scenes = [TimeseriesDataset(f'data/s2_timeseries/{scene}.nc', tile_size=tile_size, sampling_mode=sampling_mode) for scene in scenes]
+        num_workers=0, data_sources=None, data_root=None,
+        sequence=False, sequence_length=None, temporal_stride=1, min_valid=0.0):
+    scenes = [TimeseriesDataset(f'data/s2_timeseries/{scene}.nc', tile_size=tile_size, sampling_mode=sampling_mode,
+                                sequence=sequence, sequence_length=sequence_length,
+                                temporal_stride=temporal_stride, min_valid=min_valid) for scene in scenes]
     all_data = ConcatDataset(scenes)
+    if sequence:
+        return DataLoader(all_data, batch_size=batch_size, num_workers=num_workers, pin_memory=True,
+                          collate_fn=sequence_collate)
     all_data = Augment(all_data, augment_types=augment_types)
     return DataLoader(all_data, batch_size=batch_size, num_workers=num_workers, pin_memory=True)
 
@@ -1,106 +1,173 @@
+#!/usr/bin/env python
 # Copyright (c) Ingmar Nitze and Konrad Heidler
 
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
 """
-Usecase 2 Performance Debugging Script
+Usecase 2 Performance Benchmark
 
-Usage:
-    debug_performance.py [options]
-
-Options:
-    -h --help          Show this screen
-    --config=CONFIG    Specify run config to use [default: config.yml]
-    --dataset=DATASET  Dataset to use for benchmarking, should correspond to
-                       a config section under "datasets" [default: train]
+Runs the training data pipeline in a ladder of stages, from
+disk -> RAM -> device -> model -> host, on CPU or GPU.
+Every stage is warmed up first (timed separately) and then measured
+over a fixed number of samples. Results are written as JSON, so that
+they can be compared across commits.
 """
 
+import argparse
+import json
+import subprocess
 import time
-import yaml
-from docopt import docopt
+from datetime import datetime
+from itertools import cycle
+from pathlib import Path
 
 import torch
-import numpy as np
-
-from lib import get_model
-from data_loading import get_loader, DataSources
-
-steps = [
-    (0, 'Disk cache warmup'),
-    (4, 'GPU/CUDA warmup'),
- 
-    (1, 'Benchmarking Disk -> RAM                              '),
-    (2, 'Benchmarking Disk -> RAM -> GPU                       '),
-    (3, 'Benchmarking Disk -> RAM -> GPU -> Model -> GPU       '),
-    (4, 'Benchmarking Disk -> RAM -> GPU -> Model -> GPU -> RAM'),
-    (5, 'Benchmarking         RAM -> GPU                       '),
-    (6, 'Benchmarking         RAM -> GPU -> Model -> GPU       '),
-    (7, 'Benchmarking         RAM -> GPU -> Model -> GPU -> RAM'),
-    (8, 'Benchmarking                GPU -> Model -> GPU -> RAM'),
-]
-
-def main():
-    cli_args = docopt(__doc__, version="Usecase 2 Training Script 1.0")
-    config = yaml.load(open(cli_args['--config']), Loader=yaml.SafeLoader)
-
-    data_sources = DataSources(config['data_sources'])
-
-    ds_config = config['datasets'][cli_args['--dataset']]
-    if 'batch_size' not in ds_config:
-        ds_config['batch_size'] = config['batch_size']
-    ds_config['num_workers'] = config['data_threads']
-    loader = get_loader(data_sources=data_sources, **ds_config)
-
-    config['model_args']['input_channels'] = sum(src.channels for src in data_sources)
-    modelclass = get_model(config['model'])
-    model = modelclass(**config['model_args']).cuda()
-
-    img_shape = None
-    target_shape = None
-
-    for (step, description) in steps:
-        samples_done = 0
-        print(description, end=' – ')
-        tic = time.time()
-
-        if step >= 5:
-            cuda = step >= 8
-            loader = RandomDataGenerator(img_shape, target_shape, cuda=cuda)
-        for iteration, (img, target) in enumerate(loader):
-            if iteration == 0:
-                img_shape = img.shape
-                target_shape = target.shape
+import yaml
 
-            if step >= 2:
-                img = img.cuda()
-                target = target.cuda()
+from lib.data.loading import get_loader, input_channels
+from lib.models import create_model
+from lib.utils import yaml_custom
+
+parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+parser.add_argument('-c', '--config', default='config.yml', type=Path, help='Run config to use.')
+parser.add_argument('--data_dir', default='data', type=Path, help='Path to data processing dir')
+parser.add_argument('--dataset', default='train',
+                    help='Dataset to use for benchmarking, should correspond to a config section under "datasets"')
+parser.add_argument('--samples', default=512, type=int, help='Number of samples to measure per stage')
+parser.add_argument('--warmup', default=64, type=int, help='Number of warmup samples per stage')
+parser.add_argument('--batch_size', type=int, help='Override the configured batch size')
+parser.add_argument('--num_workers', type=int, help='Override the configured number of data threads')
+parser.add_argument('--device', default='auto', choices=['auto', 'cpu', 'cuda'])
+parser.add_argument('-o', '--output', type=Path,
+                    help='JSON output path. Defaults to logs/benchmark_<timestamp>.json')
+
+STAGES = [
+    ('disk>ram',                    dict(source='loader', transfer=False, model=False, to_host=False)),
+    ('disk>ram>device',             dict(source='loader', transfer=True,  model=False, to_host=False)),
+    ('disk>ram>device>model',       dict(source='loader', transfer=True,  model=True,  to_host=False)),
+    ('disk>ram>device>model>host',  dict(source='loader', transfer=True,  model=True,  to_host=True)),
+    ('ram>device',                  dict(source='ram',    transfer=True,  model=False, to_host=False)),
+    ('ram>device>model',            dict(source='ram',    transfer=True,  model=True,  to_host=False)),
+    ('ram>device>model>host',       dict(source='ram',    transfer=True,  model=True,  to_host=True)),
+    ('device>model>host',           dict(source='device', transfer=False, model=True,  to_host=True)),
+]
 
-            if step >= 3 and step != 5:
-                prediction = model(img)
 
-            if step >= 4:
+def synchronize(dev):
+    if dev.type == 'cuda':
+        torch.cuda.synchronize(dev)
+
+
+def loader_batches(loader):
+    # Unlike itertools.cycle, this re-reads the data in every epoch
+    while True:
+        for batch in loader:
+            yield batch[0]
+
+
+def batches(source, loader, ram_batch, dev):
+    if source == 'loader':
+        return loader_batches(loader)
+    elif source == 'ram':
+        return cycle([ram_batch])
+    else:
+        return cycle([ram_batch.to(dev)])
+
+
+@torch.no_grad()
+def run_stage(opts, loader, ram_batch, model, dev, n_samples):
+    samples_done = 0
+    nbytes = 0
+    synchronize(dev)
+    tic = time.perf_counter()
+    for img in batches(opts['source'], loader, ram_batch, dev):
+        if opts['transfer']:
+            img = img.to(dev, non_blocking=True)
+        if opts['model']:
+            scaling = getattr(loader, 'scaling', None)
+            prediction = model(img.to(torch.float) if scaling is None else scaling.to(img.device).scale(img))
+            if opts['to_host']:
                 prediction = prediction.cpu()
+        samples_done += img.shape[0]
+        nbytes += img.element_size() * img.numel()
+        if samples_done >= n_samples:
+            break
+    synchronize(dev)
+    seconds = time.perf_counter() - tic
+    return dict(
+        samples=samples_done,
+        seconds=seconds,
+        samples_per_second=samples_done / seconds,
+        mb_per_second=nbytes / seconds / 1e6,
+    )
+
+
+def git_describe():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'], encoding='utf8').strip()
+    except (subprocess.CalledProcessError, FileNotFoundError):
+        return None
 
-            samples_done += img.shape[0]
-            if samples_done >= 512:
-                break
 
-        toc = time.time()
-        time_elapsed = toc - tic
-        throughput = 4 * 512 * np.prod(img.shape[1:]) / time_elapsed
-        print(f'{time_elapsed:.02f} seconds. Pipeline Throughput: {throughput / 1e6:.02f}MB/s')
-
-
-class RandomDataGenerator():
-    def __init__(self, *data_shapes, cuda=False):
-        self.data_shapes = data_shapes
-        self.device = torch.device('cpu') if not cuda else torch.device('cuda')
-
-    def __iter__(self):
-        for _ in range(100):
-            data = [torch.zeros(shp, device=self.device) for shp in self.data_shapes]
-            yield data
+def main():
+    args = parser.parse_args()
+    config = yaml.load(args.config.open(), Loader=yaml_custom.SaneYAMLLoader)
+
+    if args.device == 'auto':
+        dev = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    else:
+        dev = torch.device(args.device)
+
+    data_sources = config['data_sources']
+    if 'Mask' not in data_sources:
+        data_sources = data_sources + ['Mask']
+    ds_config = config['datasets'][args.dataset]
+    ds_config['batch_size'] = args.batch_size or ds_config.get('batch_size', config['batch_size'])
+    ds_config['num_workers'] = args.num_workers if args.num_workers is not None else config['data_threads']
+    ds_config['data_sources'] = data_sources
+    ds_config['data_root'] = args.data_dir
+    loader = get_loader(ds_config)
+
+    m = config['model']
+    model = create_model(
+        arch=m['architecture'],
+        encoder_name=m['encoder'],
+        encoder_weights=None,
+        classes=1,
+        in_channels=input_channels(ds_config),
+    ).to(dev).eval()
+
+    ram_batch = next(iter(loader))[0]
+    print(f'Benchmarking on {dev}, batch shape {tuple(ram_batch.shape)} ({ram_batch.dtype})')
+
+    results = []
+    for name, opts in STAGES:
+        warmup = run_stage(opts, loader, ram_batch, model, dev, args.warmup)
+        measured = run_stage(opts, loader, ram_batch, model, dev, args.samples)
+        results.append(dict(stage=name, warmup_seconds=warmup['seconds'], **measured))
+        print(f'{name:28s} – warmup {warmup["seconds"]:6.2f}s, '
+              f'{measured["seconds"]:6.2f}s for {measured["samples"]} samples: '
+              f'{measured["samples_per_second"]:8.1f} samples/s, {measured["mb_per_second"]:8.1f} MB/s')
+
+    report = dict(
+        timestamp=datetime.now().isoformat(),
+        git_head=git_describe(),
+        device=str(dev),
+        config=str(args.config),
+        dataset=args.dataset,
+        batch_size=ds_config['batch_size'],
+        num_workers=ds_config['num_workers'],
+        batch_shape=list(ram_batch.shape),
+        batch_dtype=str(ram_batch.dtype),
+        warmup_samples=args.warmup,
+        stages=results,
+    )
+    output = args.output or Path('logs') / f'benchmark_{datetime.now().strftime("%Y-%m-%d_%H-%M-%S")}.json'
+    output.parent.mkdir(parents=True, exist_ok=True)
+    with output.open('w') as f:
+        json.dump(report, f, indent=2)
+    print(f'Results written to {output}')
 
 
 if __name__ == "__main__":
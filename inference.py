@@ -16,14 +16,24 @@ import rasterio as rio
 import numpy as np
 import matplotlib.pyplot as plt
 import os
+import shutil
+import subprocess
+import sys
 import torch
 import torch.nn as nn
 from tqdm import tqdm
 from datetime import datetime
+from functools import partial
+from rasterio.windows import Window
 
 from lib.models import create_model
 from lib.utils.plot_info import flatui_cmap
 from lib.utils import init_logging, get_logger, log_run
+from lib.utils.webtiles import build_web_tiles
+from lib.utils.telemetry import StageTimer, RunReport, peak_rss_bytes
+from lib.utils.zonal_stats import label_components, zonal_statistics, attach_zonal_statistics
+from lib.utils.job_ledger import JobLedger
+from lib.utils.blocks import plan_blocks, block_path, save_block, missing_blocks, assemble_blocks
 from lib.data_pre_processing import gdal
 
 from setup_raw_data import preprocess_directory
@@ -37,6 +47,14 @@ cmap_slope = flatui_cmap('Clouds', 'Midnight Blue')
 cmap_ndvi = 'RdYlGn'
 
 FIGSIZE_MAX = 20
+# Plots show every PLOT_DECIMATION-th pixel of the inputs
+PLOT_DECIMATION = 10
+
+# Input layers to average over each output polygon, mapped to their (shapefile-compatible) attribute prefix
+ZONAL_LAYERS = {
+    'slope': 'slope',
+    'relative_elevation': 'relel',
+}
 
 parser = argparse.ArgumentParser()
 parser.add_argument("--gdal_bin", default='', help="Path to gdal binaries")
@@ -47,16 +65,36 @@ parser.add_argument("--data_dir", default='data', type=Path, help="Path to data
 parser.add_argument("--log_dir", default='logs', type=Path, help="Path to log dir")
 parser.add_argument("--inference_dir", default='inference', type=Path, help="Main inference directory")
 parser.add_argument("-n", "--name", default=None, type=str, help="Name of inference run, data will be stored in subdirectory")
-parser.add_argument("-m", "--margin_size", default=256, type=int, help="Size of patch overlap")
+parser.add_argument("-m", "--margin_size", default='256', type=str,
+                    help="Size of patch overlap. 'auto' uses the margin calibrated by measure_margin.py")
 parser.add_argument("-p", "--patch_size", default=1024, type=int, help="Size of patches")
+parser.add_argument("--web_tiles", default=None, choices=['xyz', 'pmtiles'],
+                    help="Additionally render the predictions into a web map tile pyramid")
+parser.add_argument("--prometheus_textfile", default=None, type=Path,
+                    help="Write run metrics to this file for the node exporter's textfile collector")
+parser.add_argument("--block_size", default=None, type=int,
+                    help="Split scenes larger than this into spatial blocks (with halos of margin_size) that are predicted independently")
+parser.add_argument("--block_workers", default=0, type=int,
+                    help="Number of local worker processes for predicting blocks. 0 predicts them in this process")
+parser.add_argument("--block_index", default=None, type=int, nargs='+',
+                    help="Only predict the given blocks and exit (e.g. for array jobs on a shared filesystem). "
+                         "A later run without this option assembles the blocks")
+parser.add_argument("--ledger", default=None, type=Path,
+                    help="SQLite job ledger (e.g. on a shared filesystem). Tiles are added to the ledger "
+                         "and any number of workers pointed at the same ledger share the work")
+parser.add_argument("--stale_after", default=600, type=int,
+                    help="Seconds without heartbeat after which a claimed tile is handed out again")
+parser.add_argument("--max_attempts", default=3, type=int, help="Maximum attempts per tile when using a ledger")
 parser.add_argument("model_path", type=str, help="path to model")
-parser.add_argument("tile_to_predict", type=str, help="path to model", nargs='+')
+parser.add_argument("tile_to_predict", type=str, help="path to model", nargs='*')
 
 args = parser.parse_args()
 gdal.initialize(args)
 
 
-def predict(model, imagery, device='cpu'):
+def predict(model, imagery, device='cpu', timer=None):
+    if timer is None:
+        timer = StageTimer()
     prediction = torch.zeros(1, *imagery.shape[2:])
     weights = torch.zeros(1, *imagery.shape[2:])
 
@@ -73,21 +111,110 @@ def predict(model, imagery, device='cpu'):
                   margin_ramp.reshape(1, PS, 1)
 
     for y in np.arange(0, imagery.shape[2], (PS - MARGIN)):
+        if y + PS > imagery.shape[2]:
+            y = imagery.shape[2] - PS
+        # Cumulative count of pixels with data per column of this row of windows,
+        # to look up the number of valid pixels of every window in it
+        band_valid = imagery[0, :, y:y + PS].any(dim=0).sum(dim=0, dtype=torch.int32)
+        valid_sum = torch.nn.functional.pad(band_valid.cumsum(0, dtype=torch.int32), (1, 0))
         for x in np.arange(0, imagery.shape[3], (PS - MARGIN)):
-            if y + PS > imagery.shape[2]:
-                y = imagery.shape[2] - PS
             if x + PS > imagery.shape[3]:
                 x = imagery.shape[3] - PS
+            timer.count('windows')
+            if valid_sum[x + PS] == valid_sum[x]:
+                # Window is entirely nodata, its pixels will be masked anyways
+                timer.count('skipped_windows')
+                continue
             patch_imagery = imagery[:, :, y:y + PS, x:x + PS]
-            patch_pred = torch.sigmoid(model(patch_imagery.to(device))[0].cpu())
+            with timer.stage('forward'):
+                patch_pred = torch.sigmoid(model(patch_imagery.to(device))[0].cpu())
+
+            with timer.stage('blend'):
+                # Essentially premultiplied alpha blending
+                prediction[:, y:y + PS, x:x + PS] += patch_pred * soft_margin
+                weights[:, y:y + PS, x:x + PS] += soft_margin
+
+    with timer.stage('blend'):
+        # Avoid division by zero
+        weights = torch.where(weights == 0, torch.ones_like(weights), weights)
+        prediction = prediction / weights
+    return prediction
+
+
+def source_path(source, data_directory, planet_imagery_path):
+    if source.name == 'planet':
+        return planet_imagery_path
+    return data_directory / f'{source.name}.tif'
+
 
-            # Essentially premultiplied alpha blending
-            prediction[:, y:y + PS, x:x + PS] += patch_pred * soft_margin
-            weights[:, y:y + PS, x:x + PS] += soft_margin
+def load_data(data_directory, planet_imagery_path, timer, window=None, decimation=1):
+    """Reads and normalizes all input layers, optionally within `window` or decimated by `decimation`"""
+    data = []
+    for source in sources:
+        tif_path = source_path(source, data_directory, planet_imagery_path)
+
+        with timer.stage('read'):
+            with rio.open(tif_path) as raster:
+                out_shape = None
+                if decimation > 1:
+                    out_shape = (raster.count, -(-raster.height // decimation), -(-raster.width // decimation))
+                data_part = raster.read(window=window, out_shape=out_shape).astype(np.float32)
+
+        with timer.stage('normalize'):
+            if source.name == 'tcvis':
+                data_part = data_part[:3]
+            data_part = np.nan_to_num(data_part, nan=0.0)
+
+            data_part = data_part / np.array(source.normalization_factors, dtype=np.float32).reshape(-1, 1, 1)
+        data.append(data_part)
+    return data
 
-    # Avoid division by zero
-    weights = torch.where(weights == 0, torch.ones_like(weights), weights)
-    return prediction / weights
+
+def read_rows(tif_path, y0, y1):
+    """First band of `tif_path` in the rows [y0, y1)"""
+    with rio.open(tif_path) as raster:
+        return raster.read(1, window=Window(0, y0, raster.width, y1 - y0))
+
+
+def predict_block(block, data_directory, planet_imagery_path, block_dir, timer):
+    window = Window.from_slices((block.halo_y0, block.halo_y1), (block.halo_x0, block.halo_x1))
+    data = load_data(data_directory, planet_imagery_path, timer, window=window)
+    with timer.stage('normalize'):
+        block_data = np.concatenate(data, axis=0)
+        nodata = np.all(block_data == 0, axis=0, keepdims=True)
+        block_data = torch.from_numpy(block_data).unsqueeze(0)
+    res = predict(model, block_data, dev, timer=timer).numpy()
+    res[nodata] = np.nan
+    with timer.stage('write'):
+        save_block(block_dir, block, res)
+
+
+def run_block_workers(args, tilename, blocks):
+    """Predicts the given blocks in `args.block_workers` subprocesses of this script"""
+    cmd = [sys.executable, __file__,
+           '--gdal_bin', args.gdal_bin, '--gdal_path', args.gdal_path,
+           '--ckpt', args.ckpt, '--data_dir', str(args.data_dir), '--log_dir', str(args.log_dir),
+           '--inference_dir', str(args.inference_dir), '--margin_size', str(args.margin_size),
+           '--patch_size', str(args.patch_size), '--block_size', str(args.block_size)]
+    if args.name:
+        cmd += ['--name', args.name]
+    cmd += [str(args.model_path), tilename]
+
+    n_gpus = torch.cuda.device_count()
+    workers = []
+    for i in range(args.block_workers):
+        indices = [str(b.index) for b in blocks[i::args.block_workers]]
+        if not indices:
+            continue
+        env = dict(os.environ)
+        if n_gpus > 0:
+            # Spread the workers over all available GPUs
+            env['CUDA_VISIBLE_DEVICES'] = str(i % n_gpus)
+        workers.append(subprocess.Popen(cmd + ['--block_index', *indices], env=env))
+
+    failed = [w for w in workers if w.wait() != 0]
+    if failed:
+        raise RuntimeError(f'{len(failed)} block workers failed for {tilename}')
 
 
 def flush_rio(filepath):
@@ -99,8 +226,10 @@ def flush_rio(filepath):
         pass
 
 
-def do_inference(tilename, args=None, log_path=None):
+def do_inference(tilename, args=None, log_path=None, report=None):
     tile_logger = get_logger(f'inference.{tilename}')
+    timer = StageTimer()
+    started = datetime.now().astimezone()
     # ===== PREPARE THE DATA =====
     DATA_ROOT = args.data_dir
     INFERENCE_ROOT = args.inference_dir
@@ -109,8 +238,8 @@ def do_inference(tilename, args=None, log_path=None):
         logger.info(f'Preprocessing directory {tilename}')
         raw_directory = DATA_ROOT / 'input' / tilename
         if not raw_directory.exists():
-            logger.error(f"Couldn't find tile '{tilename}' in {DIR_ROOT}/tiles or {DIR_ROOT}/input. Skipping this tile")
-            return
+            # Raise, so that a ledger records the tile as failed instead of done
+            raise FileNotFoundError(f"Couldn't find tile '{tilename}' in {DATA_ROOT}/tiles or {DATA_ROOT}/input")
         preprocess_directory(raw_directory, args, log_path, label_required=False)
         # After this, data_directory should contain all the stuff that we need.
     
@@ -123,22 +252,46 @@ def do_inference(tilename, args=None, log_path=None):
 
     planet_imagery_path = next(data_directory.glob('*_SR.tif'))
 
-    data = []
-    for source in sources:
-        tile_logger.debug(f'loading {source.name}')
-        if source.name == 'planet':
-            tif_path = planet_imagery_path
-        else:
-            tif_path = data_directory / f'{source.name}.tif'
-
-        data_part = rio.open(tif_path).read().astype(np.float32)
+    with rio.open(planet_imagery_path) as input_raster:
+        height, width = input_raster.height, input_raster.width
+    use_blocks = args.block_size is not None and max(height, width) > args.block_size
+    if use_blocks:
+        blocks = plan_blocks(height, width, args.block_size, args.margin_size, min_window=args.patch_size)
+        block_dir = output_directory / 'blocks'
+        if args.block_index is not None:
+            # Worker mode: only predict the requested blocks
+            for idx in args.block_index:
+                block = blocks[idx]
+                if block_path(block_dir, block).exists():
+                    continue
+                block_timer = StageTimer()
+                block_started = datetime.now().astimezone()
+                predict_block(block, data_directory, planet_imagery_path, block_dir, block_timer)
+                if report is not None:
+                    report.write(dict(
+                        tile=tilename, block=idx,
+                        started=block_started.isoformat(),
+                        finished=datetime.now().astimezone().isoformat(),
+                        peak_rss_bytes=peak_rss_bytes(),
+                        **block_timer.as_dict(),
+                    ))
+            return
 
-        if source.name == 'tcvis':
-            data_part = data_part[:3]
-        data_part = np.nan_to_num(data_part, nan=0.0)
+        todo = missing_blocks(block_dir, blocks)
+        tile_logger.info(f'Predicting {len(todo)} of {len(blocks)} blocks')
+        if todo and args.block_workers > 0:
+            run_block_workers(args, tilename, todo)
+        else:
+            for block in todo:
+                predict_block(block, data_directory, planet_imagery_path, block_dir, timer)
 
-        data_part = data_part / np.array(source.normalization_factors, dtype=np.float32).reshape(-1, 1, 1)
-        data.append(data_part)
+    if use_blocks:
+        # Only an overview of the inputs for the plots, the whole scene would not fit into memory
+        data = load_data(data_directory, planet_imagery_path, timer, decimation=PLOT_DECIMATION)
+        plot_step = 1
+    else:
+        data = load_data(data_directory, planet_imagery_path, timer)
+        plot_step = PLOT_DECIMATION
 
     def make_img(filename, source, colorbar=False, mask=None, **kwargs):
         idx = sources.index(source)
@@ -153,7 +306,7 @@ def do_inference(tilename, args=None, log_path=None):
         ax.axis('off')
 
         if source.channels >= 3:
-            rgb = np.stack([np.ma.masked_where(mask, data[idx][i])[::10, ::10] for i in range(3)], axis=-1)
+            rgb = np.stack([np.ma.masked_where(mask, data[idx][i])[::plot_step, ::plot_step] for i in range(3)], axis=-1)
             rgb = np.clip(rgb, 0, 1)
             ax.imshow(rgb, aspect='equal')
         elif source.channels == 1:
@@ -172,17 +325,27 @@ def do_inference(tilename, args=None, log_path=None):
         plt.close()
 
 
-    full_data = np.concatenate(data, axis=0)
-    nodata = np.all(full_data == 0, axis=0, keepdims=True)
-    full_data = torch.from_numpy(full_data)
-    full_data = full_data.unsqueeze(0)  # Pretend this is a batch of size 1
-
-    res = predict(model, full_data, dev).numpy()
-    del full_data
-
-    res[nodata] = np.nan
-    binarized = np.ones_like(res, dtype=np.uint8) * 255
-    binarized[~nodata] = (res[~nodata] > 0.5).astype(np.uint8)
+    if use_blocks:
+        with timer.stage('assemble'):
+            res = assemble_blocks(block_dir, blocks, height, width)
+            # The blocks are NaN wherever the inputs have no data
+            nodata = np.isnan(res)
+    else:
+        with timer.stage('normalize'):
+            # Layer by layer, to avoid another copy of the whole scene
+            nodata = np.ones((1, height, width), dtype=bool)
+            for data_part in data:
+                nodata &= ~data_part.any(axis=0, keepdims=True)
+        with timer.stage('normalize'):
+            full_data = torch.from_numpy(np.concatenate(data, axis=0))
+            full_data = full_data.unsqueeze(0)  # Pretend this is a batch of size 1
+        res = predict(model, full_data, dev, timer=timer).numpy()
+        del full_data
+
+    with timer.stage('blend'):
+        res[nodata] = np.nan
+        binarized = np.ones_like(res, dtype=np.uint8) * 255
+        binarized[~nodata] = (res[~nodata] > 0.5).astype(np.uint8)
 
     # define output file paths
     out_path_proba = output_directory / 'pred_probability.tif'
@@ -190,35 +353,65 @@ def do_inference(tilename, args=None, log_path=None):
     out_path_pre_poly = output_directory / 'pred_binarized_tmp.tif'
     out_path_shp = output_directory / 'pred_binarized.shp'
 
-    # Get the input profile
-    with rio.open(planet_imagery_path) as input_raster:
-        profile = input_raster.profile
-        profile.update(
-            dtype=rio.float32,
-            count=1,
-            compress='lzw'
-        )
-
-    with rio.open(out_path_proba, 'w', **profile) as output_raster:
-        output_raster.write(res.astype(np.float32))
-    flush_rio(out_path_proba)
-
-    profile.update(
-        dtype=rio.uint8,
-        nodata=255
-    )
-    with rio.open(out_path_label, 'w', **profile) as output_raster:
-        output_raster.write(binarized)
-    flush_rio(out_path_label)
+    with timer.stage('write'):
+        # Get the input profile
+        with rio.open(planet_imagery_path) as input_raster:
+            profile = input_raster.profile
+            profile.update(
+                dtype=rio.float32,
+                count=1,
+                compress='lzw'
+            )
 
-    with rio.open(out_path_pre_poly, 'w', **profile) as output_raster:
-        output_raster.write((binarized == 1).astype(np.uint8))
-    flush_rio(out_path_pre_poly)
+        with rio.open(out_path_proba, 'w', **profile) as output_raster:
+            output_raster.write(res.astype(np.float32))
+        flush_rio(out_path_proba)
 
-    # create vectors
-    log_run(f'{gdal.polygonize} {out_path_pre_poly} -q -mask {out_path_pre_poly} -f "ESRI Shapefile" {out_path_shp}', tile_logger)
-    #log_run(f'python {gdal.polygonize} {out_path_pre_poly} -q -mask {out_path_pre_poly} -f "ESRI Shapefile" {out_path_shp}', tile_logger)
-    out_path_pre_poly.unlink()
+        profile.update(
+            dtype=rio.uint8,
+            nodata=255
+        )
+        with rio.open(out_path_label, 'w', **profile) as output_raster:
+            output_raster.write(binarized)
+        flush_rio(out_path_label)
+
+    with timer.stage('polygonize'):
+        # Label connected components, so that the polygons can be joined with their statistics
+        labels, n_components = label_components(binarized[0] == 1)
+        profile.update(dtype=rio.uint32, nodata=0)
+        with rio.open(out_path_pre_poly, 'w', **profile) as output_raster:
+            output_raster.write(labels[np.newaxis])
+        flush_rio(out_path_pre_poly)
+
+        # create vectors
+        log_run(f'{gdal.polygonize} {out_path_pre_poly} -q -mask {out_path_pre_poly} -f "ESRI Shapefile" {out_path_shp}', tile_logger)
+        #log_run(f'python {gdal.polygonize} {out_path_pre_poly} -q -mask {out_path_pre_poly} -f "ESRI Shapefile" {out_path_shp}', tile_logger)
+        out_path_pre_poly.unlink()
+
+    with timer.stage('zonal_stats'):
+        layers = {}
+        for src in sources:
+            if src.name not in ZONAL_LAYERS:
+                continue
+            if use_blocks:
+                # Read in bands of rows from the raster, in its native units
+                layers[ZONAL_LAYERS[src.name]] = partial(read_rows, source_path(src, data_directory, planet_imagery_path))
+            else:
+                # Undo the normalization to report the statistics in the layer's native units
+                layers[ZONAL_LAYERS[src.name]] = data[sources.index(src)][0] * src.normalization_factors[0]
+        stats = zonal_statistics(labels, n_components, profile['transform'], res[0], layers)
+        attach_zonal_statistics(out_path_shp, stats)
+        del labels
+
+    if use_blocks:
+        # All outputs are written, the partial predictions are not needed anymore
+        shutil.rmtree(block_dir)
+
+    if args.web_tiles:
+        with timer.stage('web_tiles'):
+            n_tiles = build_web_tiles(out_path_proba, out_path_label, output_directory / 'web_tiles',
+                                      cmap_prob, fmt=args.web_tiles, n_jobs=args.n_jobs)
+        tile_logger.info(f'Rendered web tile pyramid with {n_tiles} tiles')
 
     h, w = res.shape[1:]
     if h > w:
@@ -226,21 +419,37 @@ def do_inference(tilename, args=None, log_path=None):
     else:
         figsize = (FIGSIZE_MAX, FIGSIZE_MAX * h / w)
 
-    for src in sources:
-        kwargs = dict()
-        if src.name == 'ndvi':
-            kwargs = dict(colorbar=True, cmap=cmap_ndvi, vmin=0, vmax=1)
-        elif src.name == 'relative_elevation':
-            kwargs = dict(colorbar=True, cmap=cmap_dem, vmin=0, vmax=1)
-        elif src.name == 'slope':
-            kwargs = dict(colorbar=True, cmap=cmap_slope, vmin=0, vmax=0.5)
-        make_img(f'{src.name}.jpg', src, mask=nodata[0],**kwargs)
+    with timer.stage('plotting'):
+        for src in sources:
+            kwargs = dict()
+            if src.name == 'ndvi':
+                kwargs = dict(colorbar=True, cmap=cmap_ndvi, vmin=0, vmax=1)
+            elif src.name == 'relative_elevation':
+                kwargs = dict(colorbar=True, cmap=cmap_dem, vmin=0, vmax=1)
+            elif src.name == 'slope':
+                kwargs = dict(colorbar=True, cmap=cmap_slope, vmin=0, vmax=0.5)
+            make_img(f'{src.name}.jpg', src, mask=nodata[0, ::PLOT_DECIMATION // plot_step, ::PLOT_DECIMATION // plot_step], **kwargs)
+
+        outpath = output_directory / 'pred_probability.jpg'
+        plot_results(np.ma.masked_where(nodata[0], res[0]), outpath)
+
+        outpath = output_directory / 'pred_binarized.jpg'
+        plot_results(np.ma.masked_where(nodata[0], binarized[0]), outpath)
+
+    if report is not None:
+        finished = datetime.now().astimezone()
+        report.write(dict(
+            tile=tilename,
+            started=started.isoformat(),
+            finished=finished.isoformat(),
+            duration=(finished - started).total_seconds(),
+            height=h, width=w,
+            peak_rss_bytes=peak_rss_bytes(),
+            **timer.as_dict(),
+        ))
+    stages = ', '.join(f'{k}={v:.1f}s' for k, v in timer.times.items())
+    tile_logger.info(f'Finished {tilename}: {stages}')
 
-    outpath = output_directory / 'pred_probability.jpg'
-    plot_results(np.ma.masked_where(nodata[0], res[0]), outpath)
-
-    outpath = output_directory / 'pred_binarized.jpg'
-    plot_results(np.ma.masked_where(nodata[0], binarized[0]), outpath)
 
 if __name__ == "__main__":
     timestamp = datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
@@ -297,9 +506,41 @@ if __name__ == "__main__":
     
     model = model.to(dev)
 
+    if args.margin_size == 'auto':
+        margin_file = model_dir / 'margin.yml'
+        margin_info = None
+        if margin_file.exists():
+            margin_info = yaml.load(margin_file.open(), Loader=yaml.SafeLoader)
+        if margin_info and margin_info['patch_size'] == args.patch_size:
+            args.margin_size = margin_info['margin_size']
+            logger.info(f"Using calibrated margin of {args.margin_size}px from {margin_file}")
+        else:
+            args.margin_size = 256
+            logger.warning(f"No margin calibrated for patch size {args.patch_size} in {margin_file}, "
+                           f"falling back to {args.margin_size}px. Run measure_margin.py to calibrate.")
+    else:
+        args.margin_size = int(args.margin_size)
+
     sources = DataSources(config['data_sources'])
 
     torch.set_grad_enabled(False)
 
-    for tilename in tqdm(args.tile_to_predict):
-        do_inference(tilename, args, log_path)
+    report = RunReport(Path(args.log_dir) / f'inference-{timestamp}.jsonl', args.prometheus_textfile)
+    if args.ledger and args.block_index is None:
+        ledger = JobLedger(args.ledger, stale_after=args.stale_after, max_attempts=args.max_attempts)
+        ledger.add(args.tile_to_predict)
+        for tilename in tqdm(ledger.jobs()):
+            try:
+                with ledger.working_on(tilename):
+                    do_inference(tilename, args, log_path, report=report)
+            except Exception:
+                logger.exception(f'Inference failed for {tilename}')
+        logger.info(f'Ledger status: {ledger.counts()}')
+    else:
+        if not args.tile_to_predict:
+            parser.error('tile_to_predict is required without --ledger')
+        for tilename in tqdm(args.tile_to_predict):
+            try:
+                do_inference(tilename, args, log_path, report=report)
+            except FileNotFoundError as e:
+                logger.error(f'{e}. Skipping this tile')
@@ -0,0 +1,109 @@
+# Copyright (c) Ingmar Nitze and Konrad Heidler
+
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+Cache of decompressed HDF5 chunks in POSIX shared memory, shared by all DataLoader workers.
+
+The cache is a fixed number of equally sized slots. A small table in the same
+shared memory segment holds the key and last access time of every slot, the
+least recently used slot is evicted when a new chunk is stored.
+Chunks are cached as stored (before CF-decoding), which keeps them small.
+"""
+
+import hashlib
+import multiprocessing as mp
+import os
+import weakref
+from multiprocessing import shared_memory
+
+import numpy as np
+
+_HEADER = 3  # clock, hits, misses
+
+
+def chunk_key(netcdf_path, var, chunk_idx):
+  digest = hashlib.blake2b(f'{netcdf_path}:{var}:{chunk_idx}'.encode(), digest_size=8).digest()
+  # 0 marks empty slots
+  return int.from_bytes(digest, 'little', signed=True) or 1
+
+
+def max_chunk_bytes(netcdf_paths, variables):
+  import h5py
+  nbytes = 0
+  for path in netcdf_paths:
+    with h5py.File(path, 'r') as h5:
+      for var in variables:
+        ds = h5[var]
+        if ds.chunks:
+          nbytes = max(nbytes, int(np.prod(ds.chunks)) * ds.dtype.itemsize)
+  return nbytes
+
+
+class SharedChunkCache():
+  def __init__(self, cache_bytes, slot_bytes):
+    if slot_bytes <= 0:
+      raise ValueError('Chunk cache slots need a positive size, the variables are probably not chunked')
+    self.slot_bytes = slot_bytes
+    self.n_slots = max(1, cache_bytes // slot_bytes)
+    table_bytes = 8 * (_HEADER + 2 * self.n_slots)
+    self.shm = shared_memory.SharedMemory(create=True, size=table_bytes + self.n_slots * slot_bytes)
+    self.table_bytes = table_bytes
+    self.lock = mp.Lock()
+    self._table()[:] = 0
+    # Only the creating process removes the segment, workers just detach
+    weakref.finalize(self, _unlink, self.shm, os.getpid())
+
+  def _table(self):
+    return np.ndarray([_HEADER + 2 * self.n_slots], dtype=np.int64, buffer=self.shm.buf)
+
+  def _slot(self, slot, shape, dtype):
+    offset = self.table_bytes + slot * self.slot_bytes
+    return np.ndarray(shape, dtype=dtype, buffer=self.shm.buf, offset=offset)
+
+  def get(self, key, shape, dtype, load_fn):
+    """Returns a copy of the cached chunk `key`, calling `load_fn()` to produce it on a miss"""
+    table = self._table()
+    keys = table[_HEADER:_HEADER + self.n_slots]
+    ticks = table[_HEADER + self.n_slots:]
+    with self.lock:
+      table[0] += 1
+      hit = np.flatnonzero(keys == key)
+      if len(hit):
+        table[1] += 1
+        ticks[hit[0]] = table[0]
+        return self._slot(hit[0], shape, dtype).copy()
+      table[2] += 1
+
+    # Decompress outside of the lock, so that other workers are not blocked
+    chunk = np.ascontiguousarray(load_fn(), dtype=dtype)
+    with self.lock:
+      if not (keys == key).any():
+        slot = int(np.argmin(ticks))
+        keys[slot] = 0
+        self._slot(slot, chunk.shape, chunk.dtype)[...] = chunk
+        keys[slot] = key
+        table[0] += 1
+        ticks[slot] = table[0]
+    return chunk
+
+  def stats(self):
+    table = self._table()
+    hits, misses = int(table[1]), int(table[2])
+    return {'hits': hits, 'misses': misses, 'hit_rate': hits / max(1, hits + misses),
+            'slots': self.n_slots, 'used_slots': int((table[_HEADER:_HEADER + self.n_slots] != 0).sum())}
+
+  def reset_stats(self):
+    with self.lock:
+      self._table()[1:3] = 0
+
+
+def _unlink(shm, creator_pid):
+  if os.getpid() != creator_pid:
+    return
+  shm.close()
+  try:
+    shm.unlink()
+  except FileNotFoundError:
+    pass
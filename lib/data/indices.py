@@ -0,0 +1,152 @@
+# Copyright (c) Ingmar Nitze and Konrad Heidler
+
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+Per-scene sampling indices, persisted as .npz sidecars next to the NetCDF cubes.
+
+A sidecar stores the key (size and mtime) of the cube it was built from,
+so it is rebuilt automatically whenever the cube changes.
+"""
+
+import os
+from functools import partial
+from pathlib import Path
+
+import h5py
+import numpy as np
+from scipy import ndimage
+
+
+def cube_key(netcdf_path):
+  stat = os.stat(netcdf_path)
+  return np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+
+
+def sidecar_path(netcdf_path, kind):
+  netcdf_path = Path(netcdf_path)
+  return netcdf_path.parent / f'{netcdf_path.stem}.{kind}.npz'
+
+
+def load_or_build(netcdf_path, kind, build_fn, version=1):
+  """
+  Loads the `kind` sidecar of `netcdf_path` if it is up to date,
+  otherwise calls `build_fn(netcdf_path)` (returning a dict of arrays) and stores the result.
+  Bump `version` whenever `build_fn` changes, to invalidate existing sidecars.
+  """
+  path = sidecar_path(netcdf_path, kind)
+  key = np.append(cube_key(netcdf_path), version)
+  if path.exists():
+    with np.load(path) as index:
+      if np.array_equal(index['cube_key'], key):
+        return {k: index[k] for k in index.files if k != 'cube_key'}
+
+  index = build_fn(netcdf_path)
+  # Write to a temporary file first, as several processes might build the same index
+  tmp_path = path.parent / f'{path.stem}.{os.getpid()}.incomplete.npz'
+  try:
+    np.savez(tmp_path, cube_key=key, **index)
+    tmp_path.replace(path)
+  except OSError as e:
+    print(f'Could not store sampling index {path}: {e}')
+  return index
+
+
+def build_target_index(netcdf_path):
+  """Bounding boxes [ymin, xmin, ymax, xmax) and pixel counts of the connected target components"""
+  with h5py.File(netcdf_path, 'r') as h5:
+    targets = h5['Mask'][0] == 1
+  labels, n = ndimage.label(targets)
+  objects = ndimage.find_objects(labels)
+  bboxes = np.array([[ys.start, xs.start, ys.stop, xs.stop] for ys, xs in objects],
+                    dtype=np.int64).reshape(-1, 4)
+  counts = np.bincount(labels.ravel(), minlength=n + 1)[1:]
+  return {'bboxes': bboxes, 'pixel_counts': counts}
+
+
+def target_index(netcdf_path):
+  return load_or_build(netcdf_path, 'targets', build_target_index)
+
+
+# Cloud / unusable data masks, if a cube has them (non-zero means unusable)
+CLOUD_VARIABLES = ('UDM', 'UDM2', 'CloudMask')
+
+
+def _invalid(raw, fill):
+  invalid = np.isnan(raw) if raw.dtype.kind == 'f' else np.zeros(raw.shape, bool)
+  if fill is not None and not np.isnan(fill):
+    invalid |= (raw == fill)
+  # A pixel is missing if all of its bands are
+  return invalid.all(axis=0)
+
+
+def build_tile_index(netcdf_path, tile_size, data_sources):
+  """
+  Per-tile quality statistics for the deterministic tile grid (row-major, like `NCDataset`):
+    * positive: fraction of target pixels
+    * labelled: fraction of labelled (mask != 255) pixels
+    * nodata:   fraction of pixels where all input layers in `data_sources` are missing (fill value or NaN),
+                like the nodata masking in inference
+    * cloud:    fraction of cloudy / unusable pixels, if the cube has one of `CLOUD_VARIABLES`
+  """
+  from .loading import _decoding_params
+
+  with h5py.File(netcdf_path, 'r') as h5:
+    mask = h5['Mask']
+    H_tile, W_tile = mask.shape[1] // tile_size, mask.shape[2] // tile_size
+    W = W_tile * tile_size
+    inputs = [k for k in data_sources if k != 'Mask' and k not in CLOUD_VARIABLES]
+    clouds = [k for k in CLOUD_VARIABLES if k in h5]
+    fills = {k: _decoding_params(h5[k])[2] for k in inputs}
+
+    stats = {k: np.zeros([H_tile, W_tile], dtype=np.float32) for k in ['positive', 'labelled', 'nodata']}
+    if clouds:
+      stats['cloud'] = np.zeros([H_tile, W_tile], dtype=np.float32)
+
+    def tile_mean(pixels):
+      return pixels.reshape(tile_size, W_tile, tile_size).mean(axis=(0, 2))
+
+    for y_tile in range(H_tile):
+      rows = np.s_[y_tile * tile_size:(y_tile + 1) * tile_size, :W]
+      row = mask[0][rows]
+      stats['positive'][y_tile] = tile_mean(row == 1)
+      stats['labelled'][y_tile] = tile_mean(row != 255)
+      nodata = np.ones([tile_size, W], bool)
+      for k in inputs:
+        nodata &= _invalid(h5[k][(slice(None), *rows)], fills[k])
+      stats['nodata'][y_tile] = tile_mean(nodata)
+      if clouds:
+        cloudy = np.zeros([tile_size, W], bool)
+        for k in clouds:
+          cloudy |= (h5[k][(slice(None), *rows)] != 0).any(axis=0)
+        stats['cloud'][y_tile] = tile_mean(cloudy)
+  return {k: v.ravel() for k, v in stats.items()}
+
+
+def tile_index(netcdf_path, tile_size, data_sources):
+  # The nodata fraction depends on the input layers, so they are part of the sidecar name
+  inputs = [k for k in data_sources if k != 'Mask' and k not in CLOUD_VARIABLES]
+  return load_or_build(netcdf_path, f'tiles{tile_size}-{"+".join(inputs)}',
+                       partial(build_tile_index, tile_size=tile_size, data_sources=inputs), version=3)
+
+
+def useful_tiles(stats):
+  """Tiles that are not entirely nodata and not entirely unlabelled"""
+  return (stats['nodata'] < 1) & (stats['labelled'] > 0)
+
+
+if __name__ == '__main__':
+  import argparse
+  from tqdm import tqdm
+
+  parser = argparse.ArgumentParser(description='Builds the tile quality index sidecars for NetCDF cubes')
+  parser.add_argument('cubes', type=Path, nargs='+')
+  parser.add_argument('--tile_size', type=int, default=256)
+  parser.add_argument('--data_sources', nargs='+', required=True,
+                      help='Input layers of the training run, e.g. Sentinel2 TCVIS')
+  args = parser.parse_args()
+
+  for cube in tqdm(args.cubes):
+    stats = tile_index(cube, args.tile_size, args.data_sources)
+    print(f'{cube.stem}: {useful_tiles(stats).sum()} of {len(stats["nodata"])} tiles are useful')
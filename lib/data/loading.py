@@ -3,57 +3,293 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
+import io
+import os
+import json
+import tarfile
+import zlib
 import xarray
 import torch
 import numpy as np
-from torch.utils.data import DataLoader, ConcatDataset, Dataset
+import h5py
+from torch.utils.data import DataLoader, ConcatDataset, Dataset, IterableDataset, get_worker_info
 from math import ceil
 from einops import rearrange
 from tqdm import tqdm
 from pathlib import Path
-from skimage.measure import find_contours
 from .base import _LAYER_REGISTRY
+from .indices import target_index, tile_index, useful_tiles
+from .sampling import DistributedTileSampler, LocalityBatchSampler, PositiveAwareSampler, SharedEpoch, distributed_rank
+from .chunk_cache import SharedChunkCache, chunk_key, max_chunk_bytes
+from .profiling import ProfiledCollate, ProfiledLoader, process_timer, stage
+from ..utils.data import Augment, RingCollate, Scaling, numpy_collate
+
+
+class H5Reader():
+  """
+  Reads sample windows straight from the HDF5 structure of a NetCDF cube,
+  bypassing xarray's indexing machinery.
+  Every (worker) process opens its own file handle with a tuned chunk cache.
+  Hyperslabs are read into preallocated buffers and decoded (scale_factor,
+  add_offset, _FillValue) in float32, with fill values and NaNs set to 0,
+  which matches `.fillna(0)` on the xarray-decoded data.
+  """
+  def __init__(self, netcdf_path, variables, cache_bytes=64 << 20, chunk_cache=None):
+    self.netcdf_path = netcdf_path
+    self.variables = variables
+    self.cache_bytes = cache_bytes
+    self.chunk_cache = chunk_cache
+    self.h5 = None
+    self.pid = None
+
+  def assert_open(self):
+    # DataLoader workers must not share the file handle of the parent process
+    if self.h5 is None or self.pid != os.getpid():
+      self.h5 = h5py.File(self.netcdf_path, 'r',
+        rdcc_nbytes=self.cache_bytes,
+        rdcc_nslots=10007,
+      )
+      self.pid = os.getpid()
+      self.decoding = {k: _decoding_params(self.h5[k]) for k in self.variables}
+      self.buffers = {}
+
+  def read(self, var, y0, y1, x0, x1, decoded=True):
+    self.assert_open()
+    ds = self.h5[var]
+    shape = (ds.shape[0], y1 - y0, x1 - x0)
+    raw = self.buffers.get(var)
+    if raw is None or raw.shape != shape:
+      raw = self.buffers[var] = np.empty(shape, dtype=ds.dtype)
+    if self.chunk_cache is not None and ds.chunks:
+      self._read_cached(var, ds, raw, y0, y1, x0, x1)
+    else:
+      ds.read_direct(raw, np.s_[:, y0:y1, x0:x1])
+    if not decoded:
+      return raw.copy()
+    return decode(raw, *self.decoding[var])
+
+  def _read_cached(self, var, ds, out, y0, y1, x0, x1):
+    # Assemble the window from (shared) decompressed chunks
+    C, H, W = ds.shape
+    cb, cy, cx = ds.chunks
+    for b0 in range(0, C, cb):
+      b1 = min(C, b0 + cb)
+      for ys in range((y0 // cy) * cy, y1, cy):
+        ye = min(H, ys + cy)
+        for xs in range((x0 // cx) * cx, x1, cx):
+          xe = min(W, xs + cx)
+          chunk = self.chunk_cache.get(
+            chunk_key(self.netcdf_path, var, (b0 // cb, ys // cy, xs // cx)),
+            (b1 - b0, ye - ys, xe - xs), ds.dtype,
+            lambda: ds[b0:b1, ys:ye, xs:xe],
+          )
+          oy0, oy1 = max(y0, ys), min(y1, ye)
+          ox0, ox1 = max(x0, xs), min(x1, xe)
+          out[b0:b1, oy0 - y0:oy1 - y0, ox0 - x0:ox1 - x0] = chunk[:, oy0 - ys:oy1 - ys, ox0 - xs:ox1 - xs]
+
+  def __getstate__(self):
+    # h5py handles can't be pickled, workers will re-open the file
+    state = self.__dict__.copy()
+    state.update(h5=None, pid=None, decoding=None, buffers=None)
+    return state
+
+
+def _decoding_params(ds):
+  def attr(name):
+    value = ds.attrs.get(name)
+    return None if value is None else np.asarray(value).ravel()[0]
+  fill = attr('_FillValue')
+  if fill is None:
+    fill = attr('missing_value')
+  return attr('scale_factor'), attr('add_offset'), fill
+
+
+def channel_decoding(h5, sources):
+  """Per-channel CF decoding parameters of `sources` in an open cube"""
+  channels = []
+  for src in sources:
+    scale, offset, fill = _decoding_params(h5[src])
+    channels += [dict(source=src,
+                      scale_factor=1.0 if scale is None else float(scale),
+                      add_offset=0.0 if offset is None else float(offset),
+                      fill_value=None if fill is None or np.isnan(fill) else fill.item())] * h5[src].shape[0]
+  return channels
+
+
+def _affine_normalization(layer):
+  # The layers' normalize functions are affine maps, recover their coefficients
+  probe = layer.normalize(np.array([0, 1, 2], dtype=np.float64))
+  gain, shift = probe[1] - probe[0], probe[0]
+  if not np.isclose(probe[2], shift + 2 * gain):
+    raise ValueError(f'{layer.__name__}.normalize is not affine, it can not be deferred')
+  return gain, shift
+
+
+def deferred_scaling(channels):
+  """
+  Fuses CF decoding and layer normalization of raw stored values into one
+  per-channel `Scaling`, so that batches can stay in their stored dtype until they are on the device.
+  """
+  gain, shift, fill, fill_output = [], [], [], []
+  for c in channels:
+    norm_gain, norm_shift = _affine_normalization(_LAYER_REGISTRY[c['source']])
+    gain.append(c['scale_factor'] * norm_gain)
+    shift.append(c['add_offset'] * norm_gain + norm_shift)
+    fill.append(np.nan if c['fill_value'] is None else c['fill_value'])
+    # Fill values are decoded to 0 before normalization
+    fill_output.append(norm_shift)
+  def vec(values):
+    return torch.tensor(values, dtype=torch.float32).reshape(1, -1, 1, 1)
+  return Scaling(vec(gain), vec(shift), vec(fill), vec(fill_output))
+
+
+def decode(raw, scale_factor=None, add_offset=None, fill_value=None):
+  """CF-decodes `raw` in float32, setting fill values and NaNs to 0"""
+  out = raw.astype(np.float32)
+  if scale_factor is not None:
+    out *= np.float32(scale_factor)
+  if add_offset is not None:
+    out += np.float32(add_offset)
+  invalid = np.isnan(out)
+  if fill_value is not None and not np.isnan(fill_value):
+    invalid |= (raw == fill_value)
+  out[invalid] = 0
+  return out
+
+
+def scene_info(netcdf_path, data_sources):
+  """Channel counts and scene size of a cube, from the HDF5 metadata only"""
+  with h5py.File(netcdf_path, 'r') as h5:
+    channels = {k: h5[k].shape[0] for k in data_sources}
+    H, W = h5[data_sources[0]].shape[1:]
+  return channels, H, W
+
+
+def chunk_shape(netcdf_path, var):
+  """Spatial (y, x) chunk size of `var`, or None if it is stored contiguously"""
+  with h5py.File(netcdf_path, 'r') as h5:
+    chunks = h5[var].chunks
+  return None if chunks is None else chunks[1:]
+
+
+def input_channels(config):
+  """Number of input channels of the dataset described by `config`, without loading any data"""
+  if config.get('shards'):
+    with open(f'{config["shards"]}/index.json') as f:
+      return len(next(iter(json.load(f)['scenes'].values())))
+  scene = config['scenes'][0]
+  if config.get('tile_store'):
+    with open(f'{config["tile_store"]}/{scene}.json') as f:
+      return len(json.load(f)['channels'])
+  sources = [k for k in config['data_sources'] if k != 'Mask']
+  channels, _, _ = scene_info(f'{config["data_root"]}/{scene}.nc', sources)
+  return sum(channels.values())
 
 
 class NCDataset(Dataset):
-  def __init__(self, netcdf_path, config):
+  """
+  Samples tiles from a NetCDF cube.
+  Construction only reads the cube's metadata, the data itself
+  is opened on first access in every (worker) process.
+  Random tile positions (`random`, `regions` and `targets_only` sampling) are drawn from a generator
+  seeded with `seed`, the (shared) `epoch`, the scene and the sample index, so they do not
+  depend on which worker or rank loads a sample.
+  """
+  def __init__(self, netcdf_path, config, chunk_cache=None, epoch=None):
     self.netcdf_path = netcdf_path
+    self.seed = config.get('seed', 0)
+    self.epoch = epoch
+    self.scene_seed = zlib.crc32(str(netcdf_path).encode())
     self.tile_size = config['tile_size']
     self.data_sources = config['data_sources']
-    self.data = xarray.open_dataset(netcdf_path, cache=False)
+    self.data = None
+    self.pid = None
     self.sampling_mode = config['sampling_mode']
+    self.profile = config.get('profile', False)
+    self.defer_normalization = config.get('defer_normalization', False)
+    if self.defer_normalization:
+      if config.get('reader', 'xarray') != 'h5py':
+        raise ValueError('`defer_normalization` needs `reader: h5py`')
+      with h5py.File(netcdf_path, 'r') as h5:
+        self.input_dtype = np.result_type(*[h5[k].dtype for k in self.data_sources if k != 'Mask'])
+    if config.get('reader', 'xarray') == 'h5py':
+      self.reader = H5Reader(netcdf_path, self.data_sources,
+                             cache_bytes=config.get('h5_cache_bytes', 64 << 20),
+                             chunk_cache=chunk_cache)
+    else:
+      self.reader = None
 
-    self.H, self.W = len(self.data.y), len(self.data.x)
+    _, self.H, self.W = scene_info(netcdf_path, self.data_sources)
     self.H_tile = self.H // self.tile_size
     self.W_tile = self.W // self.tile_size
 
+    if self.sampling_mode == 'regions':
+      # Scene regions aligned to the chunking, tiles are sampled at random offsets within a region
+      region = config.get('region_size', self.tile_size)
+      chunks = chunk_shape(netcdf_path, self.data_sources[0]) or (1, 1)
+      self.region_y = ceil(region / chunks[0]) * chunks[0]
+      self.region_x = ceil(region / chunks[1]) * chunks[1]
+      self.H_region = ceil((self.H - self.tile_size + 1) / self.region_y)
+      self.W_region = ceil((self.W - self.tile_size + 1) / self.region_x)
+      # Every region has one index per tile drawn from it in an epoch
+      self.tiles_per_region = config.get('tiles_per_region', 4)
+
     if self.sampling_mode == 'targets_only':
-      targets = (self.data.Mask == 1).squeeze('mask_band').values
-      # Find Bounding boxes of targets
-      contours = find_contours(targets)
+      # Bounding boxes of the target objects, cached next to the cube
+      self.bboxes = target_index(netcdf_path)['bboxes']
+
+    # Grid tiles to use, skipping those without any input data or labels if requested
+    self.useful = None
+    self.tiles = None
+    if config.get('skip_empty_tiles') and self.sampling_mode in ('deterministic', 'random'):
+      self.useful = useful_tiles(tile_index(netcdf_path, self.tile_size, self.data_sources)).reshape(self.H_tile, self.W_tile)
+      self.tiles = np.flatnonzero(self.useful)
+      if len(self.tiles) == 0:
+        print(f'Warning: {netcdf_path} has no tiles with data and labels')
+
+  def _rng(self, idx):
+    epoch = 0 if self.epoch is None else self.epoch.value
+    return np.random.default_rng([self.seed, epoch, self.scene_seed, int(idx)])
 
-      self.bboxes = []
-      for contour in contours:
-        ymin, xmin = np.floor(contour.min(axis=0)).astype(int)
-        ymax, xmax = np.ceil(contour.max(axis=0)).astype(int)
-        self.bboxes.append([ymin, xmin, ymax, xmax])
+  def _random_position(self, rng, max_tries=20):
+    for _ in range(max_tries):
+      y0 = int(rng.integers(0, self.H - self.tile_size))
+      x0 = int(rng.integers(0, self.W - self.tile_size))
+      if self.useful is None:
+        break
+      # Accept the window if it overlaps any useful grid tile
+      ys = slice(y0 // self.tile_size, min(self.H_tile, (y0 + self.tile_size - 1) // self.tile_size + 1))
+      xs = slice(x0 // self.tile_size, min(self.W_tile, (x0 + self.tile_size - 1) // self.tile_size + 1))
+      if self.useful[ys, xs].any():
+        break
+    return y0, x0
 
   def __getitem__(self, idx):
     if self.sampling_mode == 'deterministic':
-      y_tile, x_tile = divmod(idx, self.W_tile)
+      if self.tiles is not None:
+        idx = self.tiles[idx]
+      y_tile, x_tile = divmod(int(idx), self.W_tile)
       y0 = y_tile * self.tile_size
       x0 = x_tile * self.tile_size
     elif self.sampling_mode == 'random':
-      y0 = int(torch.randint(0, self.H - self.tile_size, ()))
-      x0 = int(torch.randint(0, self.W - self.tile_size, ()))
+      y0, x0 = self._random_position(self._rng(idx))
+    elif self.sampling_mode == 'regions':
+      rng = self._rng(idx)
+      y_region, x_region = divmod(idx // self.tiles_per_region, self.W_region)
+      y0 = y_region * self.region_y
+      x0 = x_region * self.region_x
+      y0 += int(rng.integers(0, min(self.region_y, self.H - self.tile_size + 1 - y0)))
+      x0 += int(rng.integers(0, min(self.region_x, self.W - self.tile_size + 1 - x0)))
     elif self.sampling_mode == 'targets_only':
-      bbox_idx = int(torch.randint(0, len(self.bboxes), ()))
+      rng = self._rng(idx)
+      bbox_idx = int(rng.integers(0, len(self.bboxes)))
       ymin, xmin, ymax, xmax = self.bboxes[bbox_idx]
 
-      y_start = max(0, ymin - self.tile_size)
+      # Bounding boxes are end-exclusive, so that every sampled tile overlaps its object
+      y_start = max(0, ymin - self.tile_size + 1)
       y_end   = min(self.H - self.tile_size, ymax)
 
-      x_start = max(0, xmin - self.tile_size)
+      x_start = max(0, xmin - self.tile_size + 1)
       x_end   = min(self.W - self.tile_size, xmax )
 
       if y_start >= y_end or x_start >= x_end:
@@ -65,8 +301,8 @@ class NCDataset(Dataset):
         print(f'Sample x from [{x_start}, {x_end})')
         print(f'Image size: {self.H} x {self.W}')
 
-      y0 = int(torch.randint(y_start, y_end, ()))
-      x0 = int(torch.randint(x_start, x_end, ()))
+      y0 = int(rng.integers(y_start, y_end))
+      x0 = int(rng.integers(x_start, x_end))
     else:
       raise ValueError(f'Unsupported tiling mode: {self.sampling_mode!r}')
     y1 = y0 + self.tile_size
@@ -77,39 +313,436 @@ class NCDataset(Dataset):
       'y0': y0, 'x0': x0,
       'y1': y1, 'x1': x1,
     }
-    tile = {k: self.data[k][:, y0:y1, x0:x1].fillna(0).values for k in self.data_sources}
-    tile = {k: _LAYER_REGISTRY[k].normalize(v) for k, v in tile.items()}
+    with stage('open', self.profile):
+      if self.reader is not None:
+        self.reader.assert_open()
+      else:
+        self.assert_open()
+    with stage('read', self.profile):
+      if self.reader is not None:
+        decoded = not self.defer_normalization
+        tile = {k: self.reader.read(k, y0, y1, x0, x1, decoded=decoded and (k != 'Mask'))
+                for k in self.data_sources}
+      else:
+        tile = {k: self.data[k][:, y0:y1, x0:x1].fillna(0).values for k in self.data_sources}
+    if self.defer_normalization:
+      # Stored values are decoded and normalized batch-wise by `get_loader(...).scaling`
+      with stage('concatenate', self.profile):
+        img = np.concatenate([tile[k] for k in tile if k != 'Mask'], axis=0, dtype=self.input_dtype)
+    else:
+      with stage('normalize', self.profile):
+        tile = {k: _LAYER_REGISTRY[k].normalize(v) for k, v in tile.items()}
+      with stage('concatenate', self.profile):
+        img = np.concatenate([tile[k] for k in tile if k != 'Mask'], axis=0)
+    if self.profile:
+      process_timer().count('samples')
     
     if 'Mask' in tile:
       return (
-        np.concatenate([tile[k] for k in tile if k != 'Mask'], axis=0),
+        img,
         tile['Mask'],
         metadata
       )
     else:
       return (
-          np.concatenate([tile[k] for k in tile if k != 'Mask'], axis=0),
+          img,
           metadata
       )
 
   def __len__(self):
+    if self.sampling_mode == 'regions':
+      return self.H_region * self.W_region * self.tiles_per_region
+    if self.sampling_mode == 'deterministic' and self.tiles is not None:
+      return len(self.tiles)
     return self.H_tile * self.W_tile
 
+  def tile_stats(self):
+    """Quality statistics (see `build_tile_index`) for every tile of the deterministic grid"""
+    stats = tile_index(self.netcdf_path, self.tile_size, self.data_sources)
+    if self.tiles is not None:
+      stats = {k: v[self.tiles] for k, v in stats.items()}
+    return stats
+
+  def assert_open(self):
+    if self.data is None or self.pid != os.getpid():
+      self.data = xarray.open_dataset(self.netcdf_path, cache=False)
+      self.pid = os.getpid()
+
+  def __getstate__(self):
+    state = self.__dict__.copy()
+    state.update(data=None, pid=None)
+    return state
+
+
+class ChannelDecoder():
+  """Decodes and normalizes stored tiles, given the per-channel decoding parameters from `channel_decoding`"""
+  def __init__(self, channels):
+    self.scale = np.array([c['scale_factor'] for c in channels], np.float32)[:, None, None]
+    self.offset = np.array([c['add_offset'] for c in channels], np.float32)[:, None, None]
+    self.fill = [c['fill_value'] for c in channels]
+    self.source_slices = {}
+    for i, c in enumerate(channels):
+      start, _ = self.source_slices.get(c['source'], (i, i))
+      self.source_slices[c['source']] = (start, i + 1)
+
+  def __call__(self, raw):
+    out = raw.astype(np.float32)
+    out *= self.scale
+    out += self.offset
+    invalid = np.isnan(out)
+    for c, fill in enumerate(self.fill):
+      if fill is not None:
+        invalid[c] |= (raw[c] == fill)
+    out[invalid] = 0
+    for src, (start, stop) in self.source_slices.items():
+      out[start:stop] = _LAYER_REGISTRY[src].normalize(out[start:stop])
+    return out
+
+
+class TileStoreDataset(Dataset):
+  """
+  Serves the tiles of a scene converted with `python -m lib.data.tile_store`.
+  The store is memory-mapped (copy-on-write, so the files are never modified)
+  and every sample is a view into it.
+  With `raw: true`, the image is returned as is, in its stored dtype,
+  otherwise it is decoded and normalized like in `NCDataset`.
+  """
+  def __init__(self, store_path, config):
+    self.store_path = Path(store_path)
+    with open(self.store_path.with_suffix('.json')) as f:
+      self.meta = json.load(f)
+    self.netcdf_path = self.meta['source_file']
+    self.raw = config.get('raw', False) or config.get('defer_normalization', False)
+    self.has_mask = 'Mask' in self.meta['data_sources']
+    self.tiles = None
+    self.pid = None
+
+    tile_size = self.meta['tile_size']
+    if tile_size != config['tile_size']:
+      raise ValueError(f'{self.store_path} has tile size {tile_size}, expected {config["tile_size"]}')
+    sources = [src for src in config['data_sources'] if src != 'Mask']
+    stored = [src for src in self.meta['data_sources'] if src != 'Mask']
+    if sources != stored:
+      raise ValueError(f'{self.store_path} contains {stored}, expected {sources}')
+
+    self._decode = ChannelDecoder(self.meta['channels'])
+
+  def assert_open(self):
+    if self.tiles is None or self.pid != os.getpid():
+      self.tiles = np.load(self.store_path, mmap_mode='c')
+      self.pid = os.getpid()
+
+  def __getitem__(self, idx):
+    self.assert_open()
+    y0, x0 = self.meta['tiles'][idx]
+    tile_size = self.meta['tile_size']
+    metadata = {
+      'source_file': self.netcdf_path,
+      'y0': y0, 'x0': x0,
+      'y1': y0 + tile_size, 'x1': x0 + tile_size,
+    }
+    record = self.tiles[idx]
+    img = record['image']
+    if not self.raw:
+      img = self._decode(img)
+    if self.has_mask:
+      return img, _LAYER_REGISTRY['Mask'].normalize(record['mask']), metadata
+    else:
+      return img, metadata
+
+  def __len__(self):
+    return len(self.meta['tiles'])
+
+  def tile_stats(self):
+    """Target and labelled pixel fractions for every tile"""
+    self.assert_open()
+    mask = self.tiles['mask'].reshape(len(self), -1)
+    return {'positive': (mask == 1).mean(axis=1), 'labelled': (mask != 255).mean(axis=1)}
+
+  def __getstate__(self):
+    state = self.__dict__.copy()
+    state.update(tiles=None, pid=None)
+    return state
+
+
+class ShardDataset(IterableDataset):
+  """
+  Streams the samples of a shard directory written by `python -m lib.data.shards`.
+  In every epoch, the shard order is shuffled with `seed + epoch` (identically in all processes)
+  and the resulting sample stream is cut into one contiguous span per rank of a distributed run,
+  which is cut again between the loader workers.
+  With `even_ranks` (default for training), the stream wraps around so that all ranks get the same
+  number of samples, which DDP training needs. Otherwise every sample is read exactly once.
+  Each worker reads its span front to back and draws samples at random
+  from a buffer of `sample_buffer` samples.
+  """
+  def __init__(self, shard_dir, config, rank=None, world_size=None, epoch=None):
+    self.shard_dir = Path(shard_dir)
+    with open(self.shard_dir / 'index.json') as f:
+      self.meta = json.load(f)
+    self.raw = config.get('raw', False) or config.get('defer_normalization', False)
+    self.has_mask = 'Mask' in self.meta['data_sources']
+    self.shuffle = config.get('shuffle', True)
+    self.sample_buffer = config.get('sample_buffer', 256) if self.shuffle else 1
+    self.even = even_ranks({'shuffle': self.shuffle, **config})
+    self.seed = config.get('seed', 0)
+    self.epoch = epoch or SharedEpoch()
+    if rank is None:
+      rank, world_size = distributed_rank()
+    self.rank, self.world_size = rank, world_size
+
+    tile_size = self.meta['tile_size']
+    if tile_size != config['tile_size']:
+      raise ValueError(f'{self.shard_dir} has tile size {tile_size}, expected {config["tile_size"]}')
+    sources = [src for src in config['data_sources'] if src != 'Mask']
+    stored = [src for src in self.meta['data_sources'] if src != 'Mask']
+    if sources != stored:
+      raise ValueError(f'{self.shard_dir} contains {stored}, expected {sources}')
+    self.num_samples = sum(s['samples'] for s in self.meta['shards'])
+    if self.num_samples == 0:
+      raise ValueError(f'{self.shard_dir} contains no samples')
+
+    self.scene_table = list(self.meta['scenes'])
+    self.decoders = {scene: ChannelDecoder(channels) for scene, channels in self.meta['scenes'].items()}
+
+  def _rank_span(self):
+    if self.even:
+      per_rank = ceil(self.num_samples / self.world_size)
+      return self.rank * per_rank, (self.rank + 1) * per_rank
+    return (self.num_samples * self.rank // self.world_size,
+            self.num_samples * (self.rank + 1) // self.world_size)
+
+  def _worker_segments(self):
+    """(shard, skip, take) triples of the samples this rank and worker read"""
+    shards = self.meta['shards']
+    if self.shuffle:
+      order = np.random.default_rng(self.seed + self.epoch.value).permutation(len(shards))
+      shards = [shards[i] for i in order]
+    start, stop = self._rank_span()
+    info = get_worker_info()
+    if info is not None:
+      start, stop = (start + (stop - start) * info.id // info.num_workers,
+                     start + (stop - start) * (info.id + 1) // info.num_workers)
+
+    # Positions past the end of the stream wrap around to its start
+    segments = []
+    offset = start - start % self.num_samples
+    while offset < stop:
+      for shard in shards:
+        lo, hi = max(start, offset), min(stop, offset + shard['samples'])
+        if lo < hi:
+          segments.append((shard['name'], lo - offset, hi - lo))
+        offset += shard['samples']
+    return segments
+
+  def _samples(self, shard, skip=0, take=None):
+    # Skipped samples are passed over by their tar headers, without reading their data
+    with tarfile.open(self.shard_dir / shard, 'r:') as tar:
+      key, sample, count = None, {}, -1
+      for member in tar:
+        member_key, field = member.name.split('.', 1)
+        if member_key != key:
+          if sample:
+            yield sample
+            sample = {}
+          count += 1
+          if take is not None and count >= skip + take:
+            return
+        key = member_key
+        if count >= skip:
+          sample[field] = tar.extractfile(member).read()
+      if sample:
+        yield sample
+
+  def _decode(self, sample):
+    metadata = json.loads(sample['json'])
+    img = np.load(io.BytesIO(sample['image.npy']))
+    if not self.raw:
+      img = self.decoders[metadata['source_file']](img)
+    if self.has_mask:
+      mask = _LAYER_REGISTRY['Mask'].normalize(np.load(io.BytesIO(sample['mask.npy'])))
+      return img, mask, metadata
+    return img, metadata
+
+  def __iter__(self):
+    segments = self._worker_segments()
+    info = get_worker_info()
+    rng = np.random.default_rng([self.seed, self.epoch.value, self.rank, 0 if info is None else info.id])
+
+    buffer = []
+    for shard, skip, take in segments:
+      for sample in self._samples(shard, skip, take):
+        if len(buffer) < self.sample_buffer:
+          buffer.append(sample)
+          continue
+        i = rng.integers(len(buffer))
+        buffer[i], sample = sample, buffer[i]
+        yield self._decode(sample)
+    rng.shuffle(buffer)
+    for sample in buffer:
+      yield self._decode(sample)
+
+  def __len__(self):
+    start, stop = self._rank_span()
+    return stop - start
+
+
+def _common_channel_decoding(scenes):
+  channels = None
+  for scene in scenes:
+    if isinstance(scene, ShardDataset):
+      scene_channels = [(path, c) for path, c in scene.meta['scenes'].items()]
+    elif isinstance(scene, TileStoreDataset):
+      scene_channels = [(scene.netcdf_path, scene.meta['channels'])]
+    else:
+      with h5py.File(scene.netcdf_path, 'r') as h5:
+        scene_channels = [(scene.netcdf_path, channel_decoding(h5, [k for k in scene.data_sources if k != 'Mask']))]
+    for path, c in scene_channels:
+      if channels is None:
+        channels = c
+      elif c != channels:
+        raise ValueError(f'{path} is encoded differently than the other scenes, '
+                         'normalization can not be deferred')
+  return channels
+
+
+def is_training(config):
+  """Whether a dataset config is used for training, i.e. shuffled, augmented or randomly sampled"""
+  return bool(config.get('shuffle') or config.get('augment') or
+              config.get('sampling_mode', 'deterministic') != 'deterministic')
+
+
+def even_ranks(config):
+  # Padding ranks to equal length repeats tiles, which validation must not count twice,
+  # but DDP training hangs if the ranks run different numbers of steps
+  return config.get('even_ranks', is_training(config))
+
+
+def tile_sampler(config, num_samples, epoch=None, rank=None, world_size=None):
+  return DistributedTileSampler(
+    num_samples,
+    shuffle=(config['sampling_mode'] != 'deterministic'),
+    even=even_ranks(config),
+    seed=config.get('seed', 0),
+    epoch=epoch,
+    rank=rank,
+    world_size=world_size,
+  )
+
 
 def get_loader(config):
+  if config.get('shards'):
+    return get_shard_loader(config)
   root = config['data_root']
   scene_names = config['scenes']
-  scenes = [NCDataset(f'{root}/{scene}.nc', config) for scene in scene_names]
+  chunk_cache = None
+  seed = config.get('seed', 0)
+  epoch = SharedEpoch()
+  if config.get('tile_store'):
+    scenes = [TileStoreDataset(f'{config["tile_store"]}/{scene}.npy', config) for scene in scene_names]
+  else:
+    paths = [f'{root}/{scene}.nc' for scene in scene_names]
+    if config.get('chunk_cache_bytes'):
+      if config.get('reader', 'xarray') != 'h5py':
+        raise ValueError('`chunk_cache_bytes` needs `reader: h5py`')
+      slot_bytes = max_chunk_bytes(paths, config['data_sources'])
+      if slot_bytes:
+        chunk_cache = SharedChunkCache(config['chunk_cache_bytes'], slot_bytes)
+      else:
+        print('Warning: the data sources are stored contiguously (not chunked), the chunk cache is disabled')
+    scenes = [NCDataset(path, config, chunk_cache=chunk_cache, epoch=epoch) for path in paths]
   all_data = ConcatDataset(scenes)
+  collate_fn = None
+  expand = 1
+  if config.get('augment') == 'd4':
+    all_data = Augment(all_data, d4=True)
+    collate_fn = numpy_collate
+    expand = 8
+
+  sampler = None
+  if config.get('sampler'):
+    if config['sampling_mode'] != 'deterministic':
+      raise ValueError('The positive-aware sampler needs `sampling_mode: deterministic`')
+    sampler = PositiveAwareSampler(scenes, expand=expand, epoch=epoch, **{'seed': seed, **config['sampler']})
+
+  scene_table = [str(scene.netcdf_path) for scene in scenes]
+  if config.get('ring_buffer'):
+    collate_fn = RingCollate(scene_table, ring_size=config.get('ring_size', 2 * config['num_workers'] + 4),
+                             pin=torch.cuda.is_available())
+
+  if config.get('profile'):
+    collate_fn = ProfiledCollate(collate_fn)
+
+  if config['sampling_mode'] == 'regions':
+    batch_sampler = LocalityBatchSampler(
+      sum(len(scene) for scene in scenes) // config.get('tiles_per_region', 4), config['batch_size'],
+      tiles_per_region=config.get('tiles_per_region', 4),
+      shuffle_buffer=config.get('shuffle_buffer', 16),
+      expand=expand,
+      seed=seed,
+      epoch=epoch,
+    )
+    loader = DataLoader(
+      all_data,
+      batch_sampler=batch_sampler,
+      num_workers=config['num_workers'],
+      collate_fn=collate_fn,
+      persistent_workers=True,
+      pin_memory=True
+    )
+  else:
+    if sampler is None:
+      sampler = tile_sampler(config, len(all_data), epoch=epoch)
+    loader = DataLoader(
+      all_data,
+      sampler=sampler,
+      batch_size=config['batch_size'],
+      num_workers=config['num_workers'],
+      collate_fn=collate_fn,
+      persistent_workers=True,
+      pin_memory=True
+    )
+  loader.chunk_cache = chunk_cache
+  loader.scene_table = scene_table
+  loader.epoch = epoch
+  loader.scaling = None
+  if config.get('defer_normalization'):
+    loader.scaling = deferred_scaling(_common_channel_decoding(scenes))
+  if config.get('profile'):
+    loader = ProfiledLoader(loader)
+  return loader
+
+
+def get_shard_loader(config):
+  if config.get('augment') == 'd4' or config.get('sampler') or config.get('sampling_mode') == 'regions':
+    raise ValueError('Shards are streamed, `augment: d4`, `sampler` and `sampling_mode: regions` are not supported')
+  epoch = SharedEpoch()
+  dataset = ShardDataset(config['shards'], config, epoch=epoch)
+
+  collate_fn = None
+  if config.get('ring_buffer'):
+    collate_fn = RingCollate(dataset.scene_table, ring_size=config.get('ring_size', 2 * config['num_workers'] + 4),
+                             pin=torch.cuda.is_available())
+  if config.get('profile'):
+    collate_fn = ProfiledCollate(collate_fn)
 
-  return DataLoader(
-    all_data,
-    shuffle = (config['sampling_mode'] != 'deterministic'),
+  loader = DataLoader(
+    dataset,
     batch_size=config['batch_size'],
     num_workers=config['num_workers'],
+    collate_fn=collate_fn,
     persistent_workers=True,
     pin_memory=True
   )
+  loader.chunk_cache = None
+  loader.scene_table = dataset.scene_table
+  loader.epoch = epoch
+  loader.scaling = None
+  if config.get('defer_normalization'):
+    loader.scaling = deferred_scaling(_common_channel_decoding([dataset]))
+  if config.get('profile'):
+    loader = ProfiledLoader(loader)
+  return loader
 
 
 if __name__ == '__main__':
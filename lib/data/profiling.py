@@ -0,0 +1,127 @@
+# Copyright (c) Ingmar Nitze and Konrad Heidler
+
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+Optional per-stage instrumentation of the data loading pipeline (`profile: true` in a dataset config).
+
+Every process (main or DataLoader worker) accumulates stage times in its own `StageTimer`.
+`ProfiledCollate` attaches the worker's timings since the previous batch to the batch
+metadata, and `ProfiledLoader` collects them in the main process, together with the
+time the main process waited for every batch.
+"""
+
+import os
+from contextlib import nullcontext
+from time import perf_counter
+
+import numpy as np
+from torch.utils.data import default_collate, get_worker_info
+
+from ..utils.telemetry import StageTimer
+
+_timer = None
+_timer_pid = None
+
+
+def process_timer():
+  global _timer, _timer_pid
+  # Forked workers must not continue with the timer of their parent
+  if _timer is None or _timer_pid != os.getpid():
+    _timer = StageTimer()
+    _timer_pid = os.getpid()
+  return _timer
+
+
+def stage(name, enabled=True):
+  return process_timer().stage(name) if enabled else nullcontext()
+
+
+def take_timings():
+  "Returns and resets the timings of this process"
+  timings = process_timer().as_dict()
+  global _timer
+  _timer = None
+  return timings
+
+
+class ProfiledCollate():
+  def __init__(self, collate_fn=None):
+    self.collate_fn = collate_fn or default_collate
+
+  def __call__(self, samples):
+    with stage('collate'):
+      batch = self.collate_fn(samples)
+    if isinstance(batch[-1], dict):
+      info = get_worker_info()
+      batch[-1]['loader_profile'] = {
+        'worker': -1 if info is None else info.id,
+        **take_timings(),
+      }
+    return batch
+
+
+class ProfiledLoader():
+  "Wraps a DataLoader, measuring the wait time per batch and collecting the worker timings"
+  def __init__(self, loader):
+    self.loader = loader
+    self.reset()
+
+  def reset(self):
+    self.waits = []
+    self.workers = {}
+    self.main_timer = StageTimer()
+
+  def __iter__(self):
+    iterator = iter(self.loader)
+    while True:
+      tic = perf_counter()
+      try:
+        batch = next(iterator)
+      except StopIteration:
+        return
+      self.waits.append(perf_counter() - tic)
+      if isinstance(batch[-1], dict) and 'loader_profile' in batch[-1]:
+        profile = batch[-1].pop('loader_profile')
+        worker = self.workers.setdefault(profile['worker'], StageTimer())
+        for name, seconds in profile['stages'].items():
+          worker.times[name] += seconds
+        for name, n in profile['counters'].items():
+          worker.count(name, n)
+      yield batch
+
+  def __len__(self):
+    return len(self.loader)
+
+  def __getattr__(self, name):
+    return getattr(self.loader, name)
+
+  def summary(self):
+    waits = np.array(self.waits or [0.0])
+    totals = StageTimer()
+    for worker in self.workers.values():
+      for name, seconds in worker.times.items():
+        totals.times[name] += seconds
+      for name, n in worker.counters.items():
+        totals.count(name, n)
+    return {
+      'batches': len(self.waits),
+      'wait': {
+        'total': float(waits.sum()),
+        'mean': float(waits.mean()),
+        'p50': float(np.percentile(waits, 50)),
+        'p95': float(np.percentile(waits, 95)),
+        'max': float(waits.max()),
+      },
+      'main': self.main_timer.as_dict()['stages'],
+      'workers': {str(k): v.as_dict() for k, v in sorted(self.workers.items())},
+      'worker_totals': totals.as_dict(),
+    }
+
+
+def loader_stage(loader, name):
+  "Times `name` in the main process if `loader` is profiled"
+  if isinstance(loader, ProfiledLoader):
+    return loader.main_timer.stage(name)
+  return nullcontext()
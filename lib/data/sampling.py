@@ -0,0 +1,203 @@
+# Copyright (c) Ingmar Nitze and Konrad Heidler
+
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import multiprocessing as mp
+from math import ceil
+
+import numpy as np
+import torch
+from torch.utils.data import Sampler
+
+
+def distributed_rank():
+  """(rank, world_size) of this process in a `torch.distributed` run, (0, 1) otherwise"""
+  if torch.distributed.is_available() and torch.distributed.is_initialized():
+    return torch.distributed.get_rank(), torch.distributed.get_world_size()
+  return 0, 1
+
+
+class SharedEpoch():
+  """
+  Epoch number shared between the main process and the DataLoader workers.
+  Samplers and datasets seed their random draws with it, so setting it before
+  iterating a loader gives every epoch a different, but reproducible, sample order.
+  """
+  def __init__(self, epoch=0):
+    self._epoch = mp.RawValue('q', epoch)
+
+  @property
+  def value(self):
+    return self._epoch.value
+
+  @value.setter
+  def value(self, epoch):
+    self._epoch.value = epoch
+
+
+def _epoch_generator(seed, epoch):
+  generator = torch.Generator()
+  generator.manual_seed(seed + (0 if epoch is None else epoch.value))
+  return generator
+
+
+class DistributedTileSampler(Sampler):
+  """
+  Splits the indices of a dataset between the ranks of a distributed run (a single process is rank 0 of 1).
+  With `shuffle`, the indices are permuted with `seed + epoch` before splitting, identically on all ranks,
+  so the rank shards are disjoint in every epoch.
+  With `even`, the indices are padded by repetition so that all ranks get the same number of samples,
+  which DDP training needs. Turn it off for validation to evaluate every sample exactly once.
+  """
+  def __init__(self, num_samples, shuffle=True, even=True, seed=0, epoch=None, rank=None, world_size=None):
+    self.num_samples = num_samples
+    self.shuffle = shuffle
+    self.even = even
+    self.seed = seed
+    self.epoch = epoch
+    if rank is None:
+      rank, world_size = distributed_rank()
+    self.rank, self.world_size = rank, world_size
+
+  def __iter__(self):
+    if self.shuffle:
+      idx = torch.randperm(self.num_samples, generator=_epoch_generator(self.seed, self.epoch))
+    else:
+      idx = torch.arange(self.num_samples)
+    if self.even and self.num_samples and self.num_samples % self.world_size:
+      idx = idx.repeat(ceil(self.world_size / self.num_samples) + 1)[:len(self) * self.world_size]
+    return iter(idx[self.rank::self.world_size].tolist())
+
+  def __len__(self):
+    if self.even:
+      return ceil(self.num_samples / self.world_size)
+    return len(range(self.rank, self.num_samples, self.world_size))
+
+
+class PositiveAwareSampler(Sampler):
+  """
+  Draws tiles from a list of deterministic scene datasets (as concatenated by `ConcatDataset`)
+  with a fixed share of positive tiles, using their `tile_stats()`.
+
+  A tile counts as positive if at least `min_positive` of its pixels are targets.
+  Tiles with less than `min_labelled` labelled pixels are never drawn.
+  With `balance_scenes`, every scene contributes the same number of samples in expectation.
+  `expand` maps indices onto datasets that are wrapped by an index expansion (e.g. D4 augmentation).
+  If an `epoch` is given, every epoch is drawn with `seed + epoch` and split between the ranks.
+  """
+  def __init__(self, scenes, positive_fraction=0.5, min_positive=0.001, min_labelled=0.5,
+               balance_scenes=False, samples_per_epoch=None, expand=1, seed=None,
+               epoch=None, rank=None, world_size=None):
+    self.positive_fraction = positive_fraction
+    self.expand = expand
+    self.seed = seed or 0
+    self.epoch = epoch
+    self.generator = torch.Generator()
+    if seed is not None:
+      self.generator.manual_seed(seed)
+    if rank is None:
+      rank, world_size = distributed_rank()
+    self.rank, self.world_size = rank, world_size
+
+    per_scene = []
+    for scene in scenes:
+      stats = scene.tile_stats()
+      valid = stats['labelled'] >= min_labelled
+      positive = valid & (stats['positive'] >= min_positive)
+      per_scene.append((positive, valid & ~positive))
+
+    if balance_scenes:
+      self.weights = np.concatenate([self._weights(pos, neg) for pos, neg in per_scene]) / len(scenes)
+    else:
+      self.weights = self._weights(*[np.concatenate(x) for x in zip(*per_scene)])
+    if not self.weights.any():
+      raise ValueError('No tile fulfills the sampling criteria')
+    self.num_samples = ceil((samples_per_epoch or len(self.weights)) / self.world_size)
+
+  def _weights(self, positive, negative):
+    # Split the weight of each class evenly among its tiles.
+    # If a class is missing, all weight goes to the other one.
+    w = np.zeros(len(positive), dtype=np.float64)
+    n_pos, n_neg = positive.sum(), negative.sum()
+    if n_pos and n_neg:
+      w[positive] = self.positive_fraction / n_pos
+      w[negative] = (1 - self.positive_fraction) / n_neg
+    elif n_pos or n_neg:
+      w[positive | negative] = 1 / (n_pos + n_neg)
+    return w
+
+  def __iter__(self):
+    generator = self.generator if self.epoch is None else _epoch_generator(self.seed, self.epoch)
+    weights = torch.from_numpy(self.weights)
+    idx = torch.multinomial(weights, self.num_samples * self.world_size, replacement=True, generator=generator)
+    if self.expand > 1:
+      idx = idx * self.expand + torch.randint(0, self.expand, idx.shape, generator=generator)
+    return iter(idx[self.rank::self.world_size].tolist())
+
+  def __len__(self):
+    return self.num_samples
+
+
+class LocalityBatchSampler(Sampler):
+  """
+  Batches for `sampling_mode: regions`, where every chunk-aligned scene region spans
+  `tiles_per_region` consecutive dataset indices (one per tile drawn from it).
+  Regions are shuffled and streamed through a buffer of `shuffle_buffer` regions,
+  from which samples are drawn at random until each region has contributed `tiles_per_region` tiles.
+  Consecutive batches thus touch few regions, so decompressed chunks are reused from the cache.
+  If an `epoch` is given, the region order is drawn with `seed + epoch` and the regions are split
+  between the ranks (padded by repetition, so that all ranks get the same number of batches).
+  """
+  def __init__(self, num_regions, batch_size, tiles_per_region=4, shuffle_buffer=16, expand=1, seed=None,
+               epoch=None, rank=None, world_size=None):
+    self.num_regions = num_regions
+    self.batch_size = batch_size
+    self.tiles_per_region = tiles_per_region
+    self.shuffle_buffer = shuffle_buffer
+    self.expand = expand
+    self.seed = seed or 0
+    self.epoch = epoch
+    self.generator = torch.Generator()
+    if seed is not None:
+      self.generator.manual_seed(seed)
+    if rank is None:
+      rank, world_size = distributed_rank()
+    self.rank, self.world_size = rank, world_size
+
+  def _indices(self):
+    if self.epoch is not None:
+      self.generator = _epoch_generator(self.seed, self.epoch)
+    order = torch.randperm(self.num_regions, generator=self.generator)
+    per_rank = ceil(self.num_regions / self.world_size)
+    order = order.repeat(ceil(self.world_size / self.num_regions) + 1)[:per_rank * self.world_size]
+    order = order[self.rank::self.world_size].tolist()
+    regions, remaining = [], []
+    while order or regions:
+      while order and len(regions) < self.shuffle_buffer:
+        regions.append(order.pop())
+        remaining.append(self.tiles_per_region)
+      i = int(torch.randint(0, len(regions), (), generator=self.generator))
+      # Every draw from a region has its own dataset index, see `NCDataset`
+      idx = regions[i] * self.tiles_per_region + self.tiles_per_region - remaining[i]
+      if self.expand > 1:
+        idx = idx * self.expand + int(torch.randint(0, self.expand, (), generator=self.generator))
+      yield idx
+      remaining[i] -= 1
+      if remaining[i] == 0:
+        regions[i], remaining[i] = regions[-1], remaining[-1]
+        regions.pop()
+        remaining.pop()
+
+  def __iter__(self):
+    batch = []
+    for idx in self._indices():
+      batch.append(idx)
+      if len(batch) == self.batch_size:
+        yield batch
+        batch = []
+    if batch:
+      yield batch
+
+  def __len__(self):
+    return ceil(ceil(self.num_regions / self.world_size) * self.tiles_per_region / self.batch_size)
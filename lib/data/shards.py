@@ -0,0 +1,146 @@
+# Copyright (c) Ingmar Nitze and Konrad Heidler
+
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+Exports training tiles from NetCDF cubes into sequentially readable tar shards.
+
+Every sample is stored as three consecutive tar members sharing one key:
+  * <key>.image.npy: Input channels in their stored dtype
+  * <key>.mask.npy:  Mask (if `Mask` is one of the data sources)
+  * <key>.json:      Sample metadata (source file and tile window)
+
+`index.json` in the output directory lists the shards with their sample counts,
+the tile size, data sources and the per-channel decoding parameters of every scene.
+Shards are meant to be streamed front to back, e.g. from network filesystems,
+use with `shards: <out_dir>` in a dataset config, see `ShardDataset`.
+"""
+
+import argparse
+import io
+import json
+import tarfile
+from pathlib import Path
+
+import numpy as np
+from tqdm import tqdm
+
+from .indices import tile_index, useful_tiles
+from .loading import H5Reader, channel_decoding
+
+
+def _add_member(tar, name, data):
+  info = tarfile.TarInfo(name)
+  info.size = len(data)
+  tar.addfile(info, io.BytesIO(data))
+
+
+def _npy_bytes(array):
+  buf = io.BytesIO()
+  np.save(buf, np.ascontiguousarray(array))
+  return buf.getvalue()
+
+
+class ShardWriter():
+  """Writes samples into `shard-XXXXX.tar` files of `shard_size` samples each"""
+  def __init__(self, out_dir, shard_size):
+    self.out_dir = Path(out_dir)
+    self.out_dir.mkdir(parents=True, exist_ok=True)
+    self.shard_size = shard_size
+    self.shards = []
+    self.tar = None
+
+  def _next_shard(self):
+    self.close()
+    name = f'shard-{len(self.shards):05d}.tar'
+    self.tar = tarfile.open(self.out_dir / f'{name}.incomplete', 'w')
+    self.shards.append({'name': name, 'samples': 0})
+
+  def write(self, key, image, mask, metadata):
+    if self.tar is None or self.shards[-1]['samples'] == self.shard_size:
+      self._next_shard()
+    _add_member(self.tar, f'{key}.image.npy', _npy_bytes(image))
+    if mask is not None:
+      _add_member(self.tar, f'{key}.mask.npy', _npy_bytes(mask))
+    _add_member(self.tar, f'{key}.json', json.dumps(metadata).encode())
+    self.shards[-1]['samples'] += 1
+
+  def close(self):
+    if self.tar is not None:
+      self.tar.close()
+      name = self.shards[-1]['name']
+      (self.out_dir / f'{name}.incomplete').rename(self.out_dir / name)
+      self.tar = None
+
+
+def write_shards(netcdf_paths, out_dir, tile_size, data_sources, shard_size=1000, skip_empty=False, seed=0):
+  """
+  Writes the tiles of all cubes in an order shuffled with `seed`, so that every shard
+  (and every stretch within a shard) holds tiles from all over the scenes instead of
+  a strip of neighbouring tiles. Tiles are read one by one, through the readers' chunk caches.
+  """
+  out_dir = Path(out_dir)
+  inputs = [src for src in data_sources if src != 'Mask']
+  has_mask = 'Mask' in data_sources
+  writer = ShardWriter(out_dir, shard_size)
+  scenes = {}
+  readers = []
+  keys = []
+
+  for scene, netcdf_path in enumerate(netcdf_paths):
+    netcdf_path = Path(netcdf_path)
+    reader = H5Reader(netcdf_path, data_sources)
+    reader.assert_open()
+    readers.append(reader)
+    scenes[str(netcdf_path)] = channel_decoding(reader.h5, inputs)
+    H, W = reader.h5[inputs[0]].shape[1:]
+    H_tile, W_tile = H // tile_size, W // tile_size
+    if skip_empty:
+      useful = useful_tiles(tile_index(netcdf_path, tile_size, data_sources)).reshape(H_tile, W_tile)
+    else:
+      useful = np.ones([H_tile, W_tile], bool)
+    for y_tile, x_tile in np.argwhere(useful):
+      keys.append((scene, y_tile, x_tile))
+
+  keys = np.array(keys, dtype=np.int64).reshape(-1, 3)
+  keys = keys[np.random.default_rng(seed).permutation(len(keys))]
+
+  for scene, y_tile, x_tile in tqdm(keys, desc='tiles'):
+    reader = readers[scene]
+    netcdf_path = Path(reader.netcdf_path)
+    y0, y1 = int(y_tile) * tile_size, int(y_tile + 1) * tile_size
+    x0, x1 = int(x_tile) * tile_size, int(x_tile + 1) * tile_size
+    image = np.concatenate([reader.read(src, y0, y1, x0, x1, decoded=False) for src in inputs], axis=0)
+    mask = reader.read('Mask', y0, y1, x0, x1, decoded=False) if has_mask else None
+    metadata = {'source_file': str(netcdf_path), 'y0': y0, 'x0': x0, 'y1': y1, 'x1': x1}
+    writer.write(f'{netcdf_path.stem}_{y0}_{x0}', image, mask, metadata)
+  writer.close()
+
+  index = dict(
+    tile_size=tile_size,
+    data_sources=list(data_sources),
+    scenes=scenes,
+    shards=writer.shards,
+  )
+  with open(out_dir / 'index.json', 'w') as f:
+    json.dump(index, f, indent=2)
+  return index
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('cubes', type=Path, nargs='+', help='NetCDF cubes to export')
+  parser.add_argument('--out_dir', type=Path, required=True, help='Shard directory')
+  parser.add_argument('--tile_size', type=int, default=256)
+  parser.add_argument('--shard_size', type=int, default=1000, help='Samples per shard')
+  parser.add_argument('--data_sources', nargs='+', required=True,
+                      help='Layers to store, e.g. Sentinel2 TCVIS Mask')
+  parser.add_argument('--skip_empty', action='store_true',
+                      help='Leave out tiles that are entirely nodata or entirely unlabelled')
+  parser.add_argument('--seed', type=int, default=0, help='Seed of the tile order across all shards')
+  args = parser.parse_args()
+
+  index = write_shards(args.cubes, args.out_dir, args.tile_size, args.data_sources,
+                       shard_size=args.shard_size, skip_empty=args.skip_empty, seed=args.seed)
+  print(f'Wrote {sum(s["samples"] for s in index["shards"])} samples into {len(index["shards"])} shards')
@@ -0,0 +1,89 @@
+# Copyright (c) Ingmar Nitze and Konrad Heidler
+
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+Converts NetCDF cubes into pre-tiled, memory-mappable tile stores.
+
+For every scene, two files are written:
+  * <scene>.npy:  A structured array with one record per tile.
+                  Each record holds the (stored-dtype) input channels as `image`
+                  and the mask as `mask`, so a sample is a single contiguous read.
+  * <scene>.json: Tile size, tile coordinates and per-channel decoding parameters.
+
+Use with `tile_store: <out_dir>` in a dataset config, see `TileStoreDataset`.
+"""
+
+import argparse
+import json
+from pathlib import Path
+
+import numpy as np
+from tqdm import tqdm
+
+from .loading import H5Reader, channel_decoding
+
+
+def build_tile_store(netcdf_path, out_dir, tile_size, data_sources):
+  netcdf_path = Path(netcdf_path)
+  out_dir = Path(out_dir)
+  out_dir.mkdir(parents=True, exist_ok=True)
+
+  inputs = [src for src in data_sources if src != 'Mask']
+  reader = H5Reader(netcdf_path, data_sources)
+  reader.assert_open()
+  h5 = reader.h5
+
+  C = [h5[src].shape[0] for src in inputs]
+  H, W = h5[inputs[0]].shape[1:]
+  H_tile, W_tile = H // tile_size, W // tile_size
+  image_dtype = np.result_type(*[h5[src].dtype for src in inputs])
+  fields = [('image', image_dtype, (sum(C), tile_size, tile_size))]
+  if 'Mask' in data_sources:
+    fields.append(('mask', h5['Mask'].dtype, (1, tile_size, tile_size)))
+
+  channels = channel_decoding(h5, inputs)
+
+  tmp_path = out_dir / f'{netcdf_path.stem}_incomplete.npy'
+  store = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.dtype(fields), shape=(H_tile * W_tile,))
+  tiles = []
+  for y_tile in tqdm(range(H_tile), desc=netcdf_path.stem):
+    y0, y1 = y_tile * tile_size, (y_tile + 1) * tile_size
+    # Read whole rows of tiles at once to decompress every chunk only once
+    row = np.concatenate([reader.read(src, y0, y1, 0, W, decoded=False) for src in inputs], axis=0)
+    if 'Mask' in data_sources:
+      mask_row = reader.read('Mask', y0, y1, 0, W, decoded=False)
+    for x_tile in range(W_tile):
+      x0, x1 = x_tile * tile_size, (x_tile + 1) * tile_size
+      idx = y_tile * W_tile + x_tile
+      store['image'][idx] = row[:, :, x0:x1]
+      if 'Mask' in data_sources:
+        store['mask'][idx] = mask_row[:, :, x0:x1]
+      tiles.append([y0, x0])
+  store.flush()
+  del store
+  tmp_path.rename(out_dir / f'{netcdf_path.stem}.npy')
+
+  meta = dict(
+    source_file=str(netcdf_path),
+    tile_size=tile_size,
+    data_sources=list(data_sources),
+    channels=channels,
+    tiles=tiles,
+  )
+  with open(out_dir / f'{netcdf_path.stem}.json', 'w') as f:
+    json.dump(meta, f)
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('cubes', type=Path, nargs='+', help='NetCDF cubes to convert')
+  parser.add_argument('--out_dir', type=Path, required=True, help='Tile store directory')
+  parser.add_argument('--tile_size', type=int, default=256)
+  parser.add_argument('--data_sources', nargs='+', required=True,
+                      help='Layers to store, e.g. Sentinel2 TCVIS Mask')
+  args = parser.parse_args()
+
+  for cube in args.cubes:
+    build_tile_store(cube, args.out_dir, args.tile_size, args.data_sources)
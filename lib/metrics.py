@@ -4,6 +4,7 @@
 # LICENSE file in the root directory of this source tree.
 
 import numpy as np
+import torch
 
 
 def true_positive(prediction, target):
@@ -67,7 +68,39 @@ class Metrics():
                 self.running_agg[term] += additional_terms[term]
                 self.running_count[term] += 1
 
+    def sync(self):
+        """Sums the accumulated state over all ranks of a distributed run"""
+        if not (torch.distributed.is_available() and torch.distributed.is_initialized()):
+            return
+        # Ranks without any steps still need to take part, with zeros
+        all_terms = [None] * torch.distributed.get_world_size()
+        torch.distributed.all_gather_object(all_terms, sorted(self.running_agg))
+        terms = sorted(set().union(*all_terms))
+        aggregators = sorted(self.required_aggregators)
+        has_state = 1.0 if self.state else 0.0
+
+        if torch.distributed.get_backend() == 'nccl':
+            device = torch.device('cuda', torch.cuda.current_device())
+        else:
+            device = torch.device('cpu')
+        packed = torch.tensor(
+            [float(self.state.get(agg, 0)) for agg in aggregators] +
+            [float(self.running_agg.get(term, 0)) for term in terms] +
+            [float(self.running_count.get(term, 0)) for term in terms] +
+            [has_state],
+            dtype=torch.float64, device=device)
+        torch.distributed.all_reduce(packed)
+        packed = packed.cpu()
+
+        n_agg, n_terms = len(aggregators), len(terms)
+        self.state = {}
+        if packed[-1] > 0:
+            self.state = {agg: packed[i] for i, agg in enumerate(aggregators)}
+        self.running_agg = {term: packed[n_agg + i] for i, term in enumerate(terms)}
+        self.running_count = {term: int(packed[n_agg + n_terms + i]) for i, term in enumerate(terms)}
+
     def evaluate(self):
+        self.sync()
         values = {}
         if self.state:
             for m in self.metrics:
@@ -0,0 +1,85 @@
+# Copyright (c) Ingmar Nitze and Konrad Heidler
+
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+Spatial domain decomposition for very large scenes.
+
+A scene is split into blocks. Each block is predicted on its core region
+extended by a halo (the blending margin), so that the core is not affected by
+the block boundary. The cores of all blocks tile the scene without overlap and
+are assembled into the final prediction.
+Blocks are stored as .npy files, so they can be produced by separate processes
+or nodes sharing a filesystem.
+"""
+
+import os
+import uuid
+from collections import namedtuple
+from pathlib import Path
+
+import numpy as np
+
+Block = namedtuple('Block', ['index', 'y0', 'x0', 'y1', 'x1', 'halo_y0', 'halo_x0', 'halo_y1', 'halo_x1'])
+
+
+def _halo_range(lo, hi, halo, size, min_window):
+    lo, hi = max(0, lo - halo), min(size, hi + halo)
+    # Grow small windows (e.g. at the scene border) to at least `min_window`
+    if hi - lo < min_window:
+        hi = min(size, lo + min_window)
+        lo = max(0, hi - min_window)
+    return lo, hi
+
+
+def plan_blocks(height, width, block_size, halo, min_window=0):
+    """
+    Splits a (height, width) scene into blocks of at most `block_size` core pixels.
+    Halo windows are grown to at least `min_window` pixels where the scene allows.
+    """
+    blocks = []
+    for y0 in range(0, height, block_size):
+        for x0 in range(0, width, block_size):
+            y1 = min(height, y0 + block_size)
+            x1 = min(width, x0 + block_size)
+            halo_y0, halo_y1 = _halo_range(y0, y1, halo, height, min_window)
+            halo_x0, halo_x1 = _halo_range(x0, x1, halo, width, min_window)
+            blocks.append(Block(len(blocks), y0, x0, y1, x1, halo_y0, halo_x0, halo_y1, halo_x1))
+    return blocks
+
+
+def halo_slices(block):
+    """Slices of the block's core region within its halo window"""
+    return (slice(block.y0 - block.halo_y0, block.y1 - block.halo_y0),
+            slice(block.x0 - block.halo_x0, block.x1 - block.halo_x0))
+
+
+def block_path(block_dir, block):
+    return Path(block_dir) / f'block_{block.index:05d}.npy'
+
+
+def save_block(block_dir, block, prediction):
+    """Stores the core region of a (C, H_halo, W_halo) prediction for `block`"""
+    out_path = block_path(block_dir, block)
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    ys, xs = halo_slices(block)
+    # Write to a temporary file first, so that a crashed worker never leaves a partial block behind.
+    # The name is unique per writer, as workers on several hosts may share the block directory
+    tmp_path = out_path.parent / f'{out_path.stem}.{os.getpid()}-{uuid.uuid4().hex[:8]}.incomplete.npy'
+    np.save(tmp_path, np.ascontiguousarray(prediction[:, ys, xs]))
+    tmp_path.replace(out_path)
+
+
+def missing_blocks(block_dir, blocks):
+    return [b for b in blocks if not block_path(block_dir, b).exists()]
+
+
+def assemble_blocks(block_dir, blocks, height, width, channels=1, dtype=np.float32):
+    missing = missing_blocks(block_dir, blocks)
+    if missing:
+        raise FileNotFoundError(f'Missing blocks {[b.index for b in missing]} in {block_dir}')
+    out = np.empty([channels, height, width], dtype=dtype)
+    for block in blocks:
+        out[:, block.y0:block.y1, block.x0:block.x1] = np.load(block_path(block_dir, block), mmap_mode='r')
+    return out
@@ -3,10 +3,16 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
+import queue
+import threading
+import uuid
+import weakref
+
 import torch
+import torch.nn.functional as F
 import numpy as np
 import h5py
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, default_collate, get_worker_info
 from pathlib import Path
 import albumentations as A
 
@@ -91,15 +97,24 @@ class H5Dataset(Dataset):
 
 
 class Augment(Dataset):
-    def __init__(self, dataset, augment_types=None):
+    """
+    Augments the samples of `dataset`.
+    With `d4=True`, every sample is returned in all 8 orientations of the dihedral group
+    (flip-x, flip-y, transpose), encoded in the sample index. The orientations are
+    strided numpy views, so use `numpy_collate` to batch them.
+    Otherwise, `augment_types` albumentations transforms are drawn at random.
+    """
+    def __init__(self, dataset, augment_types=None, d4=False):
         self.dataset = dataset
+        self.d4 = d4
         if not augment_types:
             self.augment_types = ['HorizontalFlip', 'VerticalFlip', 'Blur', 'RandomRotate90']
         else:
             self.augment_types = augment_types
         
     def __getitem__(self, idx):
-        idx, (flipx, flipy, transpose) = self._augmented_idx_and_ops(idx)
+        if self.d4:
+            return self._d4_sample(idx)
         base = self.dataset[idx]
 
         # add Augmentation types
@@ -118,6 +133,24 @@ class Augment(Dataset):
 
         return (data, mask)
 
+    def _d4_sample(self, idx):
+        ops_idx = idx % 8
+        idx, (flipx, flipy, transpose) = self._augmented_idx_and_ops(idx)
+        sample = list(self.dataset[idx])
+        for i, x in enumerate(sample):
+            if isinstance(x, np.ndarray):
+                if transpose:
+                    x = x.swapaxes(-1, -2)
+                if flipx:
+                    x = x[..., ::-1]
+                if flipy:
+                    x = x[..., ::-1, :]
+                sample[i] = x
+            elif isinstance(x, dict):
+                # Record the orientation in the metadata
+                sample[i] = dict(x, d4=ops_idx)
+        return tuple(sample)
+
     def _augmented_idx_and_ops(self, idx):
         idx, carry = divmod(idx, 8)
         carry, flipx = divmod(carry, 2)
@@ -126,9 +159,278 @@ class Augment(Dataset):
         return idx, (flipx, flipy, transpose)
 
     def __len__(self):
+        if self.d4:
+            return 8 * len(self.dataset)
         return len(self.dataset)
 
 
+def numpy_collate(batch):
+    "Like `default_collate`, but also accepts non-contiguous numpy arrays (copied once while stacking)"
+    elem = batch[0]
+    if isinstance(elem, np.ndarray):
+        return torch.from_numpy(np.stack(batch))
+    elif isinstance(elem, (tuple, list)):
+        return [numpy_collate(samples) for samples in zip(*batch)]
+    elif isinstance(elem, dict):
+        return {key: numpy_collate([d[key] for d in batch]) for key in elem}
+    return default_collate(batch)
+
+
+class RingCollate():
+    """
+    Collates (img, mask, metadata) samples into a ring of `ring_size` preallocated batch buffers
+    in the main process (pinned if `pin` is set), so that no new tensors are allocated per batch.
+    A batch is overwritten `ring_size` batches later, so keep copies of anything held for longer.
+
+    Inside DataLoader workers, batches are collated into fresh tensors instead, as shared memory
+    handed to the main process would alias the worker's buffers. They are returned as `RingBatch`,
+    which the loader's pin memory thread copies into the pinned ring of the main process.
+    The ring must then exceed the number of batches in flight (`prefetch_factor * num_workers`)
+    plus the batches in use.
+    Metadata is returned as int32 tensors, with `source_file` replaced by its index `scene` into `scene_table`.
+    """
+    def __init__(self, scene_table, ring_size=4, pin=False):
+        self.scene_ids = {str(scene): i for i, scene in enumerate(scene_table)}
+        self.ring = BatchRing(ring_size, pin)
+        BatchRing.rings[self.ring.ring_id] = self.ring
+
+    def _metadata(self, metadata):
+        keys = [k for k in metadata[0] if k != 'source_file']
+        table = np.empty([len(metadata), len(keys) + 1], dtype=np.int32)
+        for i, m in enumerate(metadata):
+            table[i, 0] = self.scene_ids[str(m['source_file'])]
+            table[i, 1:] = [m[k] for k in keys]
+        table = torch.from_numpy(table)
+        return {'scene': table[:, 0], **{k: table[:, i + 1] for i, k in enumerate(keys)}}
+
+    def __call__(self, samples):
+        in_worker = get_worker_info() is not None
+        slot = None if in_worker else self.ring.next_slot()
+        batch = []
+        for field, values in enumerate(zip(*samples)):
+            if isinstance(values[0], dict):
+                batch.append(self._metadata(values))
+                continue
+            first = np.asarray(values[0])
+            dtype = torch.from_numpy(np.empty(0, dtype=first.dtype)).dtype
+            shape = (len(values), *first.shape)
+            buf = torch.empty(shape, dtype=dtype) if in_worker else self.ring.buffer(field, slot, shape, dtype)
+            # Copy through numpy, which also handles negatively strided views
+            out = buf.numpy()
+            for i, value in enumerate(values):
+                out[i] = value
+            batch.append(buf)
+        if in_worker:
+            return RingBatch(batch, self.ring)
+        return batch
+
+    def __getstate__(self):
+        # Workers never write into the ring, so don't ship its buffers
+        state = self.__dict__.copy()
+        state['ring'] = self.ring.empty_copy()
+        return state
+
+
+class BatchRing():
+    """`ring_size` slots of reused batch buffers, identified by `ring_id` across processes"""
+    # Rings of the live collate functions in this process
+    rings = weakref.WeakValueDictionary()
+
+    def __init__(self, ring_size, pin=False, ring_id=None):
+        self.ring_size = ring_size
+        self.pin = pin
+        self.ring_id = ring_id or uuid.uuid4().hex
+        self.buffers = {}
+        self.position = 0
+
+    def empty_copy(self):
+        return BatchRing(self.ring_size, self.pin, self.ring_id)
+
+    def main_ring(self):
+        # Copies of the ring unpickled in the main process write into the buffers of the original
+        return BatchRing.rings.get(self.ring_id, self)
+
+    def next_slot(self):
+        slot = self.position % self.ring_size
+        self.position += 1
+        return slot
+
+    def buffer(self, field, slot, shape, dtype):
+        buf = self.buffers.get((field, slot))
+        if buf is None or buf.shape[1:] != shape[1:] or buf.shape[0] < shape[0] or buf.dtype != dtype:
+            buf = torch.empty(shape, dtype=dtype, pin_memory=self.pin)
+            self.buffers[(field, slot)] = buf
+        return buf[:shape[0]]
+
+
+class RingBatch(list):
+    """A batch collated in a worker, copied into the pinned ring of the main process when it is pinned"""
+    def __init__(self, fields, ring):
+        super().__init__(fields)
+        self.ring = ring
+
+    def pin_memory(self, device=None):
+        ring = self.ring.main_ring()
+        slot = ring.next_slot()
+        batch = []
+        for field, value in enumerate(self):
+            if torch.is_tensor(value):
+                buf = ring.buffer(field, slot, value.shape, value.dtype)
+                buf.copy_(value)
+                batch.append(buf)
+            else:
+                batch.append(value)
+        return batch
+
+
+class DevicePrefetcher():
+    """
+    Iterates over `loader`, preparing the next batch with `prepare(batch)` (e.g. transfer to the
+    device, dtype conversion, normalization, augmentation) while the current batch is in use.
+    On CUDA devices, the next batch is prepared on a side stream, otherwise on a background thread.
+    """
+    def __init__(self, loader, device, prepare):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.prepare = prepare
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        if self.device.type == 'cuda':
+            return self._iter_stream()
+        return self._iter_thread()
+
+    def _iter_stream(self):
+        stream = torch.cuda.Stream(self.device)
+        iterator = iter(self.loader)
+
+        def stage():
+            batch = next(iterator, None)
+            if batch is None:
+                return None
+            with torch.cuda.stream(stream):
+                return self.prepare(batch)
+
+        upcoming = stage()
+        while upcoming is not None:
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_stream(stream)
+            for t in upcoming:
+                if torch.is_tensor(t) and t.is_cuda:
+                    # Memory allocated on the side stream is now used on the main stream
+                    t.record_stream(current_stream)
+            batch = upcoming
+            upcoming = stage()
+            yield batch
+
+    def _iter_thread(self):
+        batches = queue.Queue(maxsize=1)
+        stop = threading.Event()
+        done = object()
+
+        def work():
+            try:
+                for batch in self.loader:
+                    if stop.is_set():
+                        return
+                    batches.put(self.prepare(batch))
+                batches.put(done)
+            except BaseException as e:
+                batches.put(e)
+
+        thread = threading.Thread(target=work, daemon=True)
+        thread.start()
+        try:
+            while True:
+                batch = batches.get()
+                if batch is done:
+                    return
+                if isinstance(batch, BaseException):
+                    raise batch
+                yield batch
+        finally:
+            stop.set()
+            # Unblock the worker if it waits for a free slot
+            while thread.is_alive():
+                try:
+                    batches.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+
+
+class BatchAugment():
+    """
+    Augments whole (B, C, H, W) batches after collation, on the device they live on.
+    Random parameters are drawn per sample, geometric transforms are applied to
+    image and target alike. Mirrors the albumentations defaults of the supported
+    `augment_types` (each applied with p=0.5).
+    """
+    def __init__(self, augment_types=None, p=0.5):
+        if not augment_types:
+            augment_types = ['HorizontalFlip', 'VerticalFlip', 'Blur', 'RandomRotate90']
+        for aug_type in augment_types:
+            if not hasattr(self, aug_type):
+                raise ValueError(f'Unsupported batch augmentation: {aug_type!r}')
+        self.augment_types = augment_types
+        self.p = p
+
+    def __call__(self, img, target):
+        for aug_type in self.augment_types:
+            apply = torch.rand(img.shape[0], device=img.device) < self.p
+            img, target = getattr(self, aug_type)(img, target, apply)
+        return img, target
+
+    @staticmethod
+    def _select(apply, a, b):
+        # Per-sample choice between a and b
+        return torch.where(apply.view(-1, *[1] * (a.dim() - 1)), a, b)
+
+    def HorizontalFlip(self, img, target, apply):
+        return self._select(apply, img.flip(-1), img), self._select(apply, target.flip(-1), target)
+
+    def VerticalFlip(self, img, target, apply):
+        return self._select(apply, img.flip(-2), img), self._select(apply, target.flip(-2), target)
+
+    def RandomRotate90(self, img, target, apply):
+        if img.shape[-1] != img.shape[-2]:
+            raise ValueError('RandomRotate90 needs square tiles')
+        k = torch.randint(0, 4, apply.shape, device=img.device) * apply
+        img, target = img.clone(), target.clone()
+        for rot in (1, 2, 3):
+            idx = (k == rot).nonzero(as_tuple=True)[0]
+            if len(idx):
+                img[idx] = torch.rot90(img[idx], rot, dims=(-2, -1))
+                target[idx] = torch.rot90(target[idx], rot, dims=(-2, -1))
+        return img, target
+
+    def Blur(self, img, target, apply, blur_limit=(3, 7)):
+        # Box blur with a random odd kernel size, reflecting at the borders like cv2.blur
+        sizes = torch.randint(blur_limit[0] // 2, blur_limit[1] // 2 + 1, apply.shape, device=img.device) * 2 + 1
+        out = img.clone()
+        for size in sizes[apply].unique().tolist():
+            idx = (apply & (sizes == size)).nonzero(as_tuple=True)[0]
+            pad = size // 2
+            padded = F.pad(img[idx], (pad, pad, pad, pad), mode='reflect')
+            out[idx] = F.avg_pool2d(padded, size, stride=1)
+        return out, target
+
+    def RandomBrightnessContrast(self, img, target, apply, brightness_limit=0.2, contrast_limit=0.2):
+        B = img.shape[0]
+        alpha = 1 + (torch.rand(B, device=img.device) * 2 - 1) * contrast_limit
+        beta = (torch.rand(B, device=img.device) * 2 - 1) * brightness_limit
+        alpha = torch.where(apply, alpha, torch.ones_like(alpha)).view(B, 1, 1, 1)
+        beta = torch.where(apply, beta, torch.zeros_like(beta)).view(B, 1, 1, 1)
+        return img * alpha + beta, target
+
+    def MultiplicativeNoise(self, img, target, apply, multiplier=(0.9, 1.1)):
+        B = img.shape[0]
+        factor = multiplier[0] + torch.rand(B, device=img.device) * (multiplier[1] - multiplier[0])
+        factor = torch.where(apply, factor, torch.ones_like(factor)).view(B, 1, 1, 1)
+        return img * factor, target
+
+
 class Transformed(Dataset):
     "Wrap a dataset and apply a given transformation to every sample (e.g. Scaling)"
     def __init__(self, dataset, transform):
@@ -144,13 +446,38 @@ class Transformed(Dataset):
 
 
 class Scaling():
-    "Scales tensors by predefined normalization factors"
-    def __init__(self, normalize):
+    """
+    Scales tensors by predefined normalization factors, plus an optional shift.
+    If `fill` is given (per channel, NaN for none), fill values and NaNs are set to `fill_output`.
+    `scale` works on whole (B, C, H, W) batches, e.g. of raw integer values on the training device.
+    """
+    def __init__(self, normalize, shift=None, fill=None, fill_output=None):
         self.normalize = normalize
-        # TODO: Also allow for a shifting factor?
+        self.shift = shift
+        self.fill = fill
+        self.fill_output = fill_output
+        self._device_copies = {}
+
+    def to(self, device):
+        device = torch.device(device)
+        if device not in self._device_copies:
+            moved = [None if t is None else t.to(device)
+                     for t in (self.normalize, self.shift, self.fill, self.fill_output)]
+            self._device_copies[device] = Scaling(*moved)
+        return self._device_copies[device]
+
+    def scale(self, img):
+        img = img.to(torch.float)
+        out = img * self.normalize
+        if self.shift is not None:
+            out = out + self.shift
+        if self.fill is not None:
+            invalid = torch.isnan(img) | (img == self.fill)
+            out = torch.where(invalid, self.fill_output, out)
+        return out
 
     def __call__(self, sample):
         sample = list(sample)
         # Imagery is sample[0]
-        sample[0] = sample[0].to(torch.float) * self.normalize
+        sample[0] = self.scale(sample[0])
         return sample
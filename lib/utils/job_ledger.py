@@ -0,0 +1,163 @@
+# Copyright (c) Ingmar Nitze and Konrad Heidler
+
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import os
+import socket
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+from .logging import get_logger
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    name        TEXT PRIMARY KEY,
+    status      TEXT NOT NULL DEFAULT 'pending',
+    worker      TEXT,
+    attempts    INTEGER NOT NULL DEFAULT 0,
+    claimed_at  REAL,
+    heartbeat   REAL,
+    finished_at REAL,
+    error       TEXT
+)
+"""
+
+
+class JobLedger():
+    """
+    Durable job ledger backed by a single SQLite file, e.g. on a shared filesystem.
+
+    Any number of workers can add jobs, claim them, send heartbeats while working
+    and mark them as done or failed. Claims whose heartbeat is older than
+    `stale_after` seconds (i.e. crashed workers) are handed out again automatically,
+    until a job has been attempted `max_attempts` times.
+
+    The ledger uses SQLite's default rollback journal, because WAL mode is not
+    safe on network filesystems.
+    """
+    def __init__(self, path, stale_after=600, max_attempts=3, worker_id=None):
+        self.path = Path(path)
+        self.stale_after = stale_after
+        self.max_attempts = max_attempts
+        self.worker_id = worker_id or f'{socket.gethostname()}:{os.getpid()}'
+        self.logger = get_logger('job_ledger')
+        con = self._connect()
+        try:
+            con.execute(_SCHEMA)
+        finally:
+            con.close()
+
+    def _connect(self):
+        # Autocommit mode, transactions are managed explicitly
+        return sqlite3.connect(self.path, timeout=300, isolation_level=None)
+
+    @contextmanager
+    def _transaction(self):
+        con = self._connect()
+        try:
+            # Acquire the write lock right away, so that concurrent claims serialize
+            con.execute('BEGIN IMMEDIATE')
+            yield con
+            con.execute('COMMIT')
+        except BaseException:
+            con.execute('ROLLBACK')
+            raise
+        finally:
+            con.close()
+
+    def add(self, names):
+        with self._transaction() as con:
+            con.executemany('INSERT OR IGNORE INTO jobs (name) VALUES (?)', [(n,) for n in names])
+
+    def claim(self):
+        """Claims the next pending (or stale) job. Returns its name, or None if there is nothing left to do"""
+        now = time.time()
+        stale = now - self.stale_after
+        with self._transaction() as con:
+            con.execute("UPDATE jobs SET status = 'failed', error = 'stale claim, attempts exhausted' "
+                        "WHERE status = 'running' AND heartbeat < ? AND attempts >= ?",
+                        (stale, self.max_attempts))
+            row = con.execute("SELECT name, status, worker FROM jobs "
+                              "WHERE status = 'pending' OR (status = 'running' AND heartbeat < ?) "
+                              "ORDER BY attempts, rowid LIMIT 1", (stale,)).fetchone()
+            if row is None:
+                return None
+            name, status, previous_worker = row
+            con.execute("UPDATE jobs SET status = 'running', worker = ?, attempts = attempts + 1, "
+                        "claimed_at = ?, heartbeat = ? WHERE name = ?",
+                        (self.worker_id, now, now, name))
+        if status == 'running':
+            self.logger.warning(f'Reclaimed stale job {name} from {previous_worker}')
+        return name
+
+    def heartbeat(self, name):
+        with self._transaction() as con:
+            con.execute('UPDATE jobs SET heartbeat = ? WHERE name = ? AND worker = ?',
+                        (time.time(), name, self.worker_id))
+
+    def complete(self, name):
+        with self._transaction() as con:
+            con.execute("UPDATE jobs SET status = 'done', finished_at = ?, error = NULL "
+                        "WHERE name = ? AND worker = ?", (time.time(), name, self.worker_id))
+
+    def fail(self, name, error=''):
+        with self._transaction() as con:
+            con.execute("UPDATE jobs SET status = CASE WHEN attempts < ? THEN 'pending' ELSE 'failed' END, "
+                        "error = ? WHERE name = ? AND worker = ?",
+                        (self.max_attempts, str(error), name, self.worker_id))
+
+    def counts(self):
+        con = self._connect()
+        try:
+            return dict(con.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status').fetchall())
+        finally:
+            con.close()
+
+    @contextmanager
+    def working_on(self, name):
+        """
+        Sends heartbeats for `name` from a background thread while the block runs.
+        Marks the job as done on success and as failed (to be retried) on exceptions.
+        """
+        stop = threading.Event()
+
+        def beat():
+            while not stop.wait(self.stale_after / 4):
+                try:
+                    self.heartbeat(name)
+                except sqlite3.Error as e:
+                    self.logger.warning(f'Heartbeat for {name} failed: {e}')
+
+        thread = threading.Thread(target=beat, daemon=True)
+        thread.start()
+        try:
+            yield
+        except BaseException as e:
+            stop.set()
+            thread.join()
+            self.fail(name, repr(e))
+            raise
+        stop.set()
+        thread.join()
+        self.complete(name)
+
+    def jobs(self, poll_interval=None):
+        """
+        Iterates over claimed jobs until none are pending or running.
+        While other workers still run jobs, keeps polling, so that the jobs
+        of crashed workers are reclaimed once their heartbeats expire.
+        """
+        if poll_interval is None:
+            poll_interval = min(60, self.stale_after / 4)
+        while True:
+            name = self.claim()
+            if name is not None:
+                yield name
+            elif self.counts().get('running', 0) == 0:
+                return
+            else:
+                time.sleep(poll_interval)
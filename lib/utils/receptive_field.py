@@ -0,0 +1,104 @@
+# Copyright (c) Ingmar Nitze and Konrad Heidler
+
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+Empirical receptive field and border degradation measurements.
+
+These are used to derive the smallest overlap margin for the sliding window
+inference in `inference.py` that keeps the prediction error at patch borders
+below a given threshold.
+"""
+
+import numpy as np
+import torch
+
+
+def _distance_to_border(size):
+    idx = np.arange(size)
+    dist_1d = np.minimum(idx, size - 1 - idx)
+    return np.minimum(dist_1d.reshape(-1, 1), dist_1d.reshape(1, -1))
+
+
+@torch.no_grad()
+def border_error_profile(model, samples, patch_size, device='cpu'):
+    """
+    Compares predictions made on an isolated patch against predictions for the same
+    pixels made with full spatial context (i.e. from the center of a larger window).
+
+    `samples` is an iterable of (1, C, S, S) tensors with S > patch_size.
+    Returns the mean absolute probability difference as a function of the distance
+    (in pixels) to the patch border, as an array of length patch_size // 2.
+    """
+    dist = _distance_to_border(patch_size).ravel()
+    n_bins = patch_size // 2
+    error_sum = np.zeros(n_bins)
+    count = np.zeros(n_bins)
+
+    for sample in samples:
+        S = sample.shape[-1]
+        o = (S - patch_size) // 2
+        sample = sample.to(device, torch.float)
+        reference = torch.sigmoid(model(sample))[0, 0, o:o+patch_size, o:o+patch_size]
+        cropped = torch.sigmoid(model(sample[..., o:o+patch_size, o:o+patch_size]))[0, 0]
+        error = (cropped - reference).abs().cpu().numpy().ravel()
+
+        error_sum += np.bincount(dist, weights=error, minlength=n_bins)[:n_bins]
+        count += np.bincount(dist, minlength=n_bins)[:n_bins]
+
+    return error_sum / np.maximum(count, 1)
+
+
+def effective_receptive_field(model, samples, device='cpu', mass=0.95):
+    """
+    Measures the effective receptive field by backpropagating from the center
+    output pixel to the input. Returns the radial gradient profile and the radius
+    (Chebyshev distance) containing `mass` of the total input gradient magnitude.
+    """
+    profile = None
+    for sample in samples:
+        sample = sample.to(device, torch.float).requires_grad_(True)
+        out = model(sample)
+        H, W = out.shape[-2:]
+        out[0, 0, H // 2, W // 2].backward()
+        grad = sample.grad.abs().sum(dim=(0, 1)).cpu().numpy()
+
+        cy, cx = sample.shape[-2] // 2, sample.shape[-1] // 2
+        yy, xx = np.indices(grad.shape)
+        radius = np.maximum(np.abs(yy - cy), np.abs(xx - cx)).ravel()
+        radial = np.bincount(radius, weights=grad.ravel())
+        profile = radial if profile is None else profile + radial
+
+    cumulative = np.cumsum(profile) / profile.sum()
+    erf_radius = int(np.searchsorted(cumulative, mass))
+    return profile, erf_radius
+
+
+def blended_edge_error(profile, margin):
+    """
+    Upper bound for the error inside the overlap zone of two neighbouring patches
+    after linear alpha-blending, given the single-patch `profile` from
+    `border_error_profile`.
+    """
+    if margin == 0:
+        return profile[0]
+    margin = min(margin, len(profile))
+    if margin == 1:
+        return profile[0]
+    w = np.linspace(0, 1, margin)
+    d_near = np.arange(margin)
+    d_far = margin - 1 - d_near
+    return np.max(w * profile[d_near] + (1 - w) * profile[d_far])
+
+
+def minimal_margin(profile, threshold, step=32):
+    """
+    Smallest overlap margin (multiple of `step`) for which the blended
+    edge error stays below `threshold`. Falls back to half the patch size.
+    """
+    max_margin = len(profile)
+    for margin in range(0, max_margin + 1, step):
+        if blended_edge_error(profile, margin) < threshold:
+            return margin
+    return max_margin
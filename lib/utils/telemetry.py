@@ -0,0 +1,97 @@
+# Copyright (c) Ingmar Nitze and Konrad Heidler
+
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import json
+import os
+import resource
+import sys
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from pathlib import Path
+
+
+def peak_rss_bytes():
+    """Peak resident set size of this process"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS reports bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class StageTimer():
+    "Accumulates wall clock time per named stage and arbitrary counters"
+    def __init__(self):
+        self.times = defaultdict(float)
+        self.counters = defaultdict(int)
+
+    @contextmanager
+    def stage(self, name):
+        tic = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.times[name] += time.perf_counter() - tic
+
+    def count(self, name, n=1):
+        self.counters[name] += n
+
+    def as_dict(self):
+        return {
+            'stages': {k: round(v, 6) for k, v in self.times.items()},
+            'counters': dict(self.counters),
+        }
+
+
+class RunReport():
+    """
+    Machine-readable run report. Every call to `write` appends one JSON record to
+    `jsonl_path`. If `prometheus_path` is given, aggregated totals are additionally
+    written in the Prometheus textfile-collector format after every record.
+    """
+    def __init__(self, jsonl_path, prometheus_path=None, prefix='thaw_slump_inference'):
+        self.jsonl_path = Path(jsonl_path)
+        self.prometheus_path = Path(prometheus_path) if prometheus_path else None
+        self.prefix = prefix
+        self.stage_totals = defaultdict(float)
+        self.counter_totals = defaultdict(int)
+        self.records = 0
+
+    def write(self, record):
+        with self.jsonl_path.open('a') as f:
+            print(json.dumps(record), file=f)
+
+        self.records += 1
+        for stage, seconds in record.get('stages', {}).items():
+            self.stage_totals[stage] += seconds
+        for key, value in record.get('counters', {}).items():
+            self.counter_totals[key] += value
+        if self.prometheus_path:
+            self.write_prometheus()
+
+    def write_prometheus(self):
+        p = self.prefix
+        lines = [
+            f'# HELP {p}_stage_seconds_total Time spent per inference stage.',
+            f'# TYPE {p}_stage_seconds_total counter',
+        ]
+        for stage, seconds in sorted(self.stage_totals.items()):
+            lines.append(f'{p}_stage_seconds_total{{stage="{stage}"}} {seconds:.6f}')
+        lines += [
+            f'# HELP {p}_tiles_total Number of processed tiles.',
+            f'# TYPE {p}_tiles_total counter',
+            f'{p}_tiles_total {self.records}',
+        ]
+        for key, value in sorted(self.counter_totals.items()):
+            lines += [f'# TYPE {p}_{key}_total counter', f'{p}_{key}_total {value}']
+        lines += [
+            f'# TYPE {p}_peak_rss_bytes gauge',
+            f'{p}_peak_rss_bytes {peak_rss_bytes()}',
+            f'# TYPE {p}_last_record_timestamp_seconds gauge',
+            f'{p}_last_record_timestamp_seconds {time.time():.3f}',
+        ]
+        # The textfile collector might read at any time, so write atomically
+        tmp_path = self.prometheus_path.parent / f'.{self.prometheus_path.name}.{os.getpid()}'
+        tmp_path.write_text('\n'.join(lines) + '\n')
+        tmp_path.replace(self.prometheus_path)
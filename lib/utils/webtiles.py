@@ -0,0 +1,265 @@
+# Copyright (c) Ingmar Nitze and Konrad Heidler
+
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+Renders inference outputs into a web map tile pyramid (XYZ directory or PMTiles archive).
+
+Tiles are rendered from the raster overviews in parallel. A manifest next to the tiles
+records content hashes of the source rasters in blocks of `HASH_BLOCK` pixels, so that
+a re-run only rebuilds the overviews and re-renders the tiles if (and where) the sources changed.
+"""
+
+import hashlib
+import io
+import json
+import math
+from pathlib import Path
+
+import numpy as np
+import rasterio as rio
+from rasterio.enums import Resampling
+from rasterio.transform import from_bounds
+from rasterio.vrt import WarpedVRT
+from rasterio.windows import Window, bounds as window_bounds
+from rasterio.warp import transform_bounds
+from joblib import Parallel, delayed
+from PIL import Image
+
+TILE_SIZE = 256
+WEB_MERCATOR = 'EPSG:3857'
+ORIGIN = 20037508.342789244
+OUTLINE_COLOR = (255, 255, 255, 255)
+HASH_BLOCK = 1024
+
+
+def tile_bounds(z, x, y):
+    """Bounds (left, bottom, right, top) of an XYZ tile in web mercator coordinates"""
+    size = 2 * ORIGIN / (1 << z)
+    left = -ORIGIN + x * size
+    top = ORIGIN - y * size
+    return left, top - size, left + size, top
+
+
+def tiles_for_bounds(bounds, z):
+    left, bottom, right, top = bounds
+    size = 2 * ORIGIN / (1 << z)
+    n = 1 << z
+    x0 = max(0, int((left + ORIGIN) // size))
+    x1 = min(n - 1, int((right + ORIGIN) // size))
+    y0 = max(0, int((ORIGIN - top) // size))
+    y1 = min(n - 1, int((ORIGIN - bottom) // size))
+    return [(z, x, y) for x in range(x0, x1 + 1) for y in range(y0, y1 + 1)]
+
+
+def zoom_range(raster_path):
+    """Derive the zoom levels between 'whole scene in one tile' and native resolution"""
+    with rio.open(raster_path) as src:
+        bounds = transform_bounds(src.crs, WEB_MERCATOR, *src.bounds)
+        # Native resolution in web mercator units at the scene's latitude
+        res_merc = (bounds[2] - bounds[0]) / src.width
+    extent = max(bounds[2] - bounds[0], bounds[3] - bounds[1])
+    max_zoom = int(math.ceil(math.log2(2 * ORIGIN / (TILE_SIZE * res_merc))))
+    min_zoom = int(math.floor(math.log2(2 * ORIGIN / extent)))
+    return max(0, min(min_zoom, max_zoom)), max(0, max_zoom)
+
+
+def build_overviews(raster_path, resampling=Resampling.average):
+    with rio.open(raster_path, 'r+') as dst:
+        factors = []
+        factor = 2
+        while max(dst.width, dst.height) / factor >= TILE_SIZE:
+            factors.append(factor)
+            factor *= 2
+        if factors:
+            dst.build_overviews(factors, resampling)
+            dst.update_tags(ns='rio_overview', resampling=resampling.name)
+
+
+def _read_tile(src, tile, resampling, nodata):
+    transform = from_bounds(*tile_bounds(*tile), TILE_SIZE, TILE_SIZE)
+    with WarpedVRT(src, crs=WEB_MERCATOR, transform=transform,
+                   width=TILE_SIZE, height=TILE_SIZE,
+                   src_nodata=nodata, nodata=nodata,
+                   resampling=resampling) as vrt:
+        return vrt.read(1)
+
+
+def _outline(label):
+    inner = np.pad(label, 1, mode='edge')
+    interior = inner[:-2, 1:-1] & inner[2:, 1:-1] & inner[1:-1, :-2] & inner[1:-1, 2:]
+    return label & ~interior
+
+
+def render_tile(probability, label, cmap):
+    """Renders a probability tile with `cmap` and overlays the polygon outlines from `label`"""
+    nodata = np.isnan(probability)
+    rgba = cmap(np.nan_to_num(probability), bytes=True)
+    rgba[nodata, 3] = 0
+    rgba[_outline(label == 1)] = OUTLINE_COLOR
+    buffer = io.BytesIO()
+    Image.fromarray(rgba, 'RGBA').save(buffer, format='PNG', optimize=True)
+    return buffer.getvalue()
+
+
+def source_state(raster_path):
+    """Grid of `raster_path` and content hashes of its full resolution pixels in `HASH_BLOCK` blocks"""
+    with rio.open(raster_path) as src:
+        grid = {'crs': src.crs.to_string(), 'transform': list(src.transform)[:6],
+                'shape': [src.height, src.width]}
+        blocks = {}
+        for row in range(0, src.height, HASH_BLOCK):
+            for col in range(0, src.width, HASH_BLOCK):
+                window = Window(col, row, min(HASH_BLOCK, src.width - col), min(HASH_BLOCK, src.height - row))
+                blocks[f'{row}/{col}'] = hashlib.sha1(src.read(1, window=window).tobytes()).hexdigest()
+    return {'grid': grid, 'blocks': blocks}
+
+
+def changed_bounds(old, new):
+    """
+    Web mercator bounds of the blocks that differ between two `source_state`s,
+    or None if the raster grid changed (and everything has to be redone).
+    """
+    if old is None or old['grid'] != new['grid']:
+        return None
+    grid = new['grid']
+    transform = rio.Affine(*grid['transform'])
+    height, width = grid['shape']
+    bounds = []
+    for key, digest in new['blocks'].items():
+        if old['blocks'].get(key) == digest:
+            continue
+        row, col = (int(v) for v in key.split('/'))
+        window = Window(col, row, min(HASH_BLOCK, width - col), min(HASH_BLOCK, height - row))
+        bounds.append(transform_bounds(grid['crs'], WEB_MERCATOR, *window_bounds(window, transform)))
+    return np.array(bounds, dtype=np.float64).reshape(-1, 4)
+
+
+def _touched(tiles, bounds):
+    """Which of `tiles` (all of one zoom level) intersect any of `bounds`"""
+    if len(tiles) == 0 or len(bounds) == 0:
+        return np.zeros(len(tiles), bool)
+    tb = np.array([tile_bounds(*t) for t in tiles])
+    # Resampling from the overviews spreads a change over neighbouring tile pixels
+    margin = 2 * (2 * ORIGIN / (1 << tiles[0][0])) / TILE_SIZE
+    touched = np.zeros(len(tiles), bool)
+    for i in range(0, len(tiles), 4096):
+        t = tb[i:i + 4096, None]
+        touched[i:i + 4096] = ((t[..., 0] < bounds[:, 2] + margin) & (t[..., 2] > bounds[:, 0] - margin) &
+                               (t[..., 1] < bounds[:, 3] + margin) & (t[..., 3] > bounds[:, 1] - margin)).any(axis=1)
+    return touched
+
+
+def _render_tiles(proba_path, label_path, tiles, xyz_dir, cmap):
+    results = []
+    with rio.open(proba_path) as proba_src, rio.open(label_path) as label_src:
+        for tile in tiles:
+            probability = _read_tile(proba_src, tile, Resampling.average, np.nan)
+            label = _read_tile(label_src, tile, Resampling.max, 255)
+            key = '{}/{}/{}'.format(*tile)
+            out_path = xyz_dir / f'{key}.png'
+            if np.all(np.isnan(probability)):
+                # Tile became empty -> remove stale renderings
+                out_path.unlink(missing_ok=True)
+                results.append((key, False))
+                continue
+            out_path.parent.mkdir(parents=True, exist_ok=True)
+            out_path.write_bytes(render_tile(probability, label, cmap))
+            results.append((key, True))
+    return results
+
+
+def write_pmtiles(xyz_dir, tiles, out_path, bounds_lonlat):
+    from pmtiles.writer import Writer
+    from pmtiles.tile import zxy_to_tileid, TileType, Compression
+
+    tiles = sorted(tiles, key=lambda t: zxy_to_tileid(*t))
+    zooms = [t[0] for t in tiles]
+    tmp_path = out_path.parent / f'{out_path.stem}_incomplete{out_path.suffix}'
+    with open(tmp_path, 'wb') as f:
+        writer = Writer(f)
+        for z, x, y in tiles:
+            writer.write_tile(zxy_to_tileid(z, x, y), (xyz_dir / f'{z}/{x}/{y}.png').read_bytes())
+        west, south, east, north = [int(v * 1e7) for v in bounds_lonlat]
+        writer.finalize({
+            'tile_type': TileType.PNG,
+            'tile_compression': Compression.NONE,
+            'min_lon_e7': west, 'min_lat_e7': south,
+            'max_lon_e7': east, 'max_lat_e7': north,
+            'center_zoom': min(zooms),
+            'center_lon_e7': (west + east) // 2,
+            'center_lat_e7': (south + north) // 2,
+        }, {'name': out_path.stem, 'format': 'png'})
+    tmp_path.rename(out_path)
+
+
+def build_web_tiles(proba_path, label_path, out_dir, cmap, fmt='xyz',
+                    zooms=None, n_jobs=-1):
+    """
+    Renders `proba_path` (float32 probabilities, NaN = nodata) and the outlines of
+    `label_path` (uint8 binarized prediction) into `out_dir/xyz/{z}/{x}/{y}.png`.
+    If `fmt` is 'pmtiles', the tiles are additionally packed into `out_dir/<name>.pmtiles`.
+
+    Returns the number of tiles in the pyramid.
+    """
+    out_dir = Path(out_dir)
+    xyz_dir = out_dir / 'xyz'
+    xyz_dir.mkdir(parents=True, exist_ok=True)
+    manifest_path = out_dir / 'tiles.json'
+    manifest = json.loads(manifest_path.read_text()) if manifest_path.exists() else {}
+    if 'sources' not in manifest:
+        manifest = {'sources': {}, 'tiles': {}}
+
+    sources = {'proba': (proba_path, Resampling.average), 'label': (label_path, Resampling.nearest)}
+    states = {name: source_state(path) for name, (path, _) in sources.items()}
+    changed = []
+    for name, (path, resampling) in sources.items():
+        bounds = changed_bounds(manifest['sources'].get(name), states[name])
+        changed.append(bounds)
+        with rio.open(path) as src:
+            has_overviews = bool(src.overviews(1))
+        if bounds is None or len(bounds) or not has_overviews:
+            build_overviews(path, resampling)
+    if manifest.get('cmap') != cmap.name or any(bounds is None for bounds in changed):
+        changed = None
+    else:
+        changed = np.concatenate(changed)
+
+    if zooms is None:
+        zooms = zoom_range(proba_path)
+    with rio.open(proba_path) as src:
+        bounds = transform_bounds(src.crs, WEB_MERCATOR, *src.bounds)
+        bounds_lonlat = transform_bounds(src.crs, 'EPSG:4326', *src.bounds)
+
+    tiles = {}
+    dirty = []
+    for z in range(zooms[0], zooms[1] + 1):
+        level = tiles_for_bounds(bounds, z)
+        touched = np.ones(len(level), bool) if changed is None else _touched(level, changed)
+        for tile, is_touched in zip(level, touched):
+            key = '{}/{}/{}'.format(*tile)
+            rendered = manifest['tiles'].get(key)
+            if is_touched or rendered is None or (rendered and not (xyz_dir / f'{key}.png').exists()):
+                dirty.append(tile)
+            else:
+                tiles[key] = rendered
+
+    # Tiles that are no longer part of the pyramid
+    for key in set(manifest['tiles']) - set('{}/{}/{}'.format(*t) for t in dirty) - set(tiles):
+        (xyz_dir / f'{key}.png').unlink(missing_ok=True)
+
+    n_chunks = max(1, min(len(dirty), 64))
+    chunks = [dirty[i::n_chunks] for i in range(n_chunks)]
+    results = Parallel(n_jobs=n_jobs)(
+        delayed(_render_tiles)(proba_path, label_path, chunk, xyz_dir, cmap)
+        for chunk in chunks if chunk)
+    tiles.update(r for chunk in results for r in chunk)
+
+    manifest = {'sources': states, 'cmap': cmap.name, 'tiles': tiles}
+    manifest_path.write_text(json.dumps(manifest, indent=0, sort_keys=True))
+
+    rendered = [tuple(int(v) for v in key.split('/')) for key, is_rendered in tiles.items() if is_rendered]
+    if fmt == 'pmtiles' and rendered and (dirty or not (out_dir / f'{Path(proba_path).stem}.pmtiles').exists()):
+        write_pmtiles(xyz_dir, rendered, out_dir / f'{Path(proba_path).stem}.pmtiles', bounds_lonlat)
+    return len(rendered)
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# flake8: noqa: E501
+# Copyright (c) Ingmar Nitze and Konrad Heidler
+
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+Usecase 2 Overlap Margin Calibration Script
+
+Measures the effective receptive field and the border degradation of a trained
+model and stores the smallest overlap margin that keeps the blended edge error
+below a threshold in <model_path>/margin.yml.
+This file is picked up by `inference.py --margin_size auto`.
+"""
+
+import argparse
+from pathlib import Path
+
+import torch
+import torch.nn as nn
+import yaml
+
+from lib.models import create_model
+from lib.data.loading import NCDataset
+from lib.utils import init_logging, get_logger
+from lib.utils.receptive_field import border_error_profile, effective_receptive_field, \
+    blended_edge_error, minimal_margin
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--ckpt", default='latest', type=str, help="Checkpoint to use")
+parser.add_argument("--log_dir", default='logs', type=Path, help="Path to log dir")
+parser.add_argument("-p", "--patch_size", default=1024, type=int, help="Size of patches used for inference")
+parser.add_argument("--context", default=256, type=int, help="Additional context around the patch for the reference prediction")
+parser.add_argument("--samples", default=8, type=int, help="Number of samples to average over")
+parser.add_argument("--threshold", default=0.01, type=float, help="Maximum tolerated mean absolute probability error at patch seams")
+parser.add_argument("--step", default=32, type=int, help="Margin granularity")
+parser.add_argument("--cubes", default=[], type=Path, nargs='*',
+                    help="NetCDF cubes to draw real samples from. Uses uniform noise if none are given.")
+parser.add_argument("model_path", type=Path, help="path to model")
+
+
+def load_model(model_dir, ckpt, dev):
+    config = yaml.load((model_dir / 'config.yml').open(), Loader=yaml.SafeLoader)
+    m = config['model']
+    model = create_model(
+        arch=m['architecture'],
+        encoder_name=m['encoder'],
+        encoder_weights=None,
+        classes=1,
+        in_channels=m['input_channels']
+    )
+    if ckpt == 'latest':
+        ckpt = max(int(c.stem) for c in model_dir.glob('checkpoints/*.pt'))
+    ckpt = model_dir / 'checkpoints' / f'{int(ckpt):02d}.pt'
+
+    # Parallelized Model needs to be declared before loading
+    try:
+        model.load_state_dict(torch.load(ckpt, map_location=dev))
+    except RuntimeError:
+        model = nn.DataParallel(model)
+        model.load_state_dict(torch.load(ckpt, map_location=dev))
+    return model.to(dev).eval(), config
+
+
+def sample_generator(args, config, size):
+    if args.cubes:
+        ds_config = dict(tile_size=size, sampling_mode='random',
+                         data_sources=[s for s in config['data_sources'] if s != 'Mask'])
+        datasets = [NCDataset(cube, ds_config) for cube in args.cubes]
+        for i in range(args.samples):
+            # Random windows are seeded by the sample index, so every sample needs its own index
+            img, _ = datasets[i % len(datasets)][i // len(datasets)]
+            yield torch.from_numpy(img).unsqueeze(0)
+    else:
+        for _ in range(args.samples):
+            yield torch.rand(1, config['model']['input_channels'], size, size)
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    args.log_dir.mkdir(exist_ok=True)
+    init_logging(args.log_dir / 'measure_margin.log')
+    logger = get_logger('measure_margin')
+
+    dev = torch.device("cpu") if not torch.cuda.is_available() else torch.device("cuda")
+    model, config = load_model(args.model_path, args.ckpt, dev)
+
+    size = args.patch_size + 2 * args.context
+    profile = border_error_profile(model, sample_generator(args, config, size), args.patch_size, dev)
+    _, erf_radius = effective_receptive_field(model, sample_generator(args, config, size), dev)
+    margin = minimal_margin(profile, args.threshold, step=args.step)
+
+    logger.info(f'Effective receptive field radius: {erf_radius}px')
+    logger.info(f'Border error at 0/32/64/128px: ' + ', '.join(f'{profile[min(d, len(profile)-1)]:.4f}' for d in [0, 32, 64, 128]))
+    logger.info(f'Minimal margin for threshold {args.threshold}: {margin}px '
+                f'(blended edge error {blended_edge_error(profile, margin):.4f})')
+
+    result = dict(
+        patch_size=args.patch_size,
+        margin_size=margin,
+        threshold=args.threshold,
+        receptive_field_radius=erf_radius,
+        border_error=[float(e) for e in profile],
+    )
+    with open(args.model_path / 'margin.yml', 'w') as f:
+        yaml.dump(result, f)
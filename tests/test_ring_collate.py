@@ -0,0 +1,58 @@
+# Copyright (c) Ingmar Nitze and Konrad Heidler
+
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Dataset
+from torch.utils.data._utils.pin_memory import pin_memory
+
+from lib.utils.data import RingCollate
+
+
+class CountingDataset(Dataset):
+    def __len__(self):
+        return 64
+
+    def __getitem__(self, idx):
+        img = np.full([3, 8, 8], idx, dtype=np.uint8)
+        mask = np.full([1, 8, 8], idx % 2, dtype=np.uint8)
+        return img, mask, {'source_file': 'scene', 'y0': idx, 'x0': 0}
+
+
+def reference_batches(batch_size):
+    loader = DataLoader(CountingDataset(), batch_size=batch_size)
+    return [(img.clone(), mask.clone()) for img, mask, _ in loader]
+
+
+def test_batches_survive_ring_wraparound_with_workers():
+    collate = RingCollate(['scene'], ring_size=2)
+    loader = DataLoader(CountingDataset(), batch_size=4, num_workers=2, collate_fn=collate)
+    held = list(loader)
+    for (img, mask, metadata), (ref_img, ref_mask) in zip(held, reference_batches(4)):
+        assert torch.equal(img, ref_img)
+        assert torch.equal(mask, ref_mask)
+        assert metadata['y0'].tolist() == ref_img[:, 0, 0, 0].tolist()
+
+
+def test_pin_stage_reuses_ring_slots():
+    collate = RingCollate(['scene'], ring_size=3)
+    loader = DataLoader(CountingDataset(), batch_size=4, num_workers=2, collate_fn=collate)
+    pointers = []
+    for batch, (ref_img, _) in zip(loader, reference_batches(4)):
+        img, mask, _ = pin_memory(batch)
+        assert torch.equal(img, ref_img)
+        pointers.append(img.data_ptr())
+    assert len(set(pointers)) == 3
+
+
+def test_main_process_ring_overwrites_after_ring_size():
+    collate = RingCollate(['scene'], ring_size=2)
+    loader = DataLoader(CountingDataset(), batch_size=4, num_workers=0, collate_fn=collate)
+    batches = iter(loader)
+    first, _, _ = next(batches)
+    next(batches)
+    next(batches)
+    # The third batch went into the slot of the first one
+    assert first[:, 0, 0, 0].tolist() == [8, 9, 10, 11]
@@ -0,0 +1,38 @@
+# Copyright (c) Ingmar Nitze and Konrad Heidler
+
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+from collections import Counter
+
+import pytest
+
+from lib.data.loading import tile_sampler
+
+TRAIN = dict(sampling_mode='deterministic', augment=True, shuffle=True)
+VAL = dict(sampling_mode='deterministic', augment=False, shuffle=False)
+
+
+def rank_indices(config, num_samples, world_size):
+    return [list(tile_sampler(config, num_samples, rank=rank, world_size=world_size))
+            for rank in range(world_size)]
+
+
+@pytest.mark.parametrize('world_size', [2, 3, 4])
+def test_deterministic_training_ranks_get_equal_lengths(world_size):
+    indices = rank_indices(TRAIN, 10, world_size)
+    assert all(len(idx) == len(indices[0]) for idx in indices)
+    assert set(i for idx in indices for i in idx) == set(range(10))
+
+
+@pytest.mark.parametrize('world_size', [3, 4])
+def test_validation_ranks_read_every_tile_once(world_size):
+    indices = rank_indices(VAL, 10, world_size)
+    counts = Counter(i for idx in indices for i in idx)
+    assert sorted(counts) == list(range(10))
+    assert set(counts.values()) == {1}
+
+
+def test_even_ranks_overrides_default():
+    indices = rank_indices(dict(VAL, even_ranks=True), 10, 3)
+    assert [len(idx) for idx in indices] == [4, 4, 4]
@@ -0,0 +1,69 @@
+# Copyright (c) Ingmar Nitze and Konrad Heidler
+
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import json
+from collections import Counter
+
+import numpy as np
+import pytest
+from torch.utils.data import DataLoader
+
+from lib.data.loading import ShardDataset
+from lib.data.shards import ShardWriter
+
+SHARD_SIZES = [7, 3, 11, 5]
+
+
+@pytest.fixture
+def shard_dir(tmp_path):
+    writer = ShardWriter(tmp_path, 1)
+    idx = 0
+    for size in SHARD_SIZES:
+        writer.shard_size = size
+        writer._next_shard()
+        for _ in range(size):
+            image = np.full([2, 4, 4], idx, dtype=np.uint16)
+            writer.write(f'tile_{idx}', image, None, {'source_file': 'scene', 'y0': idx, 'x0': 0})
+            idx += 1
+    writer.close()
+    index = dict(tile_size=4, data_sources=['Sentinel2'], scenes={'scene': []}, shards=writer.shards)
+    with open(tmp_path / 'index.json', 'w') as f:
+        json.dump(index, f)
+    return tmp_path
+
+
+def config(**kwargs):
+    return dict(tile_size=4, data_sources=['Sentinel2'], raw=True, **kwargs)
+
+
+def rank_samples(shard_dir, world_size, num_workers=0, **kwargs):
+    samples = []
+    for rank in range(world_size):
+        dataset = ShardDataset(shard_dir, config(**kwargs), rank=rank, world_size=world_size)
+        loader = DataLoader(dataset, batch_size=None, num_workers=num_workers)
+        ids = [int(metadata['y0']) for _, metadata in loader]
+        assert len(ids) == len(dataset)
+        samples.append(ids)
+    return samples
+
+
+@pytest.mark.parametrize('world_size', [2, 3, 4])
+@pytest.mark.parametrize('num_workers', [0, 2])
+def test_even_ranks_get_equal_sample_counts(shard_dir, world_size, num_workers):
+    samples = rank_samples(shard_dir, world_size, num_workers)
+    total = sum(SHARD_SIZES)
+    assert all(len(ids) == -(-total // world_size) for ids in samples)
+    # Every sample is read, only the padding repeats some of them
+    counts = Counter(i for ids in samples for i in ids)
+    assert set(counts) == set(range(total))
+    assert sum(counts.values()) - total < world_size
+
+
+@pytest.mark.parametrize('world_size', [2, 3])
+def test_uneven_ranks_read_every_sample_once(shard_dir, world_size):
+    samples = rank_samples(shard_dir, world_size, num_workers=2, shuffle=False, even_ranks=False)
+    assert sorted(i for ids in samples for i in ids) == list(range(sum(SHARD_SIZES)))
+    # Without shuffling, the ranks read the stream in order
+    assert [i for ids in samples for i in sorted(ids)] == list(range(sum(SHARD_SIZES)))
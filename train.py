@@ -9,6 +9,7 @@
 Usecase 2 Training Script
 """
 import argparse
+import json
 import re
 import subprocess
 import sys
@@ -28,7 +29,9 @@ from einops import rearrange
 
 from lib import Metrics, Accuracy, Precision, Recall, F1, IoU
 from lib.models import create_model, create_loss
-from lib.data.loading import get_loader
+from lib.data.loading import get_loader, input_channels
+from lib.data.profiling import ProfiledLoader, loader_stage
+from lib.utils.data import BatchAugment, DevicePrefetcher
 from lib.utils import showexample, plot_metrics, plot_precision_recall, init_logging, get_logger, yaml_custom
 
 parser = argparse.ArgumentParser()
@@ -69,17 +72,16 @@ class Engine:
       if 'Mask' not in self.data_sources:
         self.data_sources += ['Mask']
       self.dataset_cache = {}
+      self.loader_profiles = []
 
       # Sanity check: No scene should be in train AND val at the same time
-      train_scenes = set(self.config['datasets']['train']['scenes'])
-      val_scenes = set(self.config['datasets']['val']['scenes'])
+      train_scenes = set(self.config['datasets']['train'].get('scenes', []))
+      val_scenes = set(self.config['datasets']['val'].get('scenes', []))
       intersection = train_scenes & val_scenes
       if intersection:
         self.logger.warn(f'The following scenes are in train and val: {intersection}')
 
-      for (img, mask, _) in self.get_dataloader('val'):
-        self.config['model']['input_channels'] = img.shape[1]
-        break
+      self.config['model']['input_channels'] = input_channels(self.get_dataset_config('val'))
 
       m = self.config['model']
       self.model = create_model(
@@ -158,11 +160,12 @@ class Engine:
                   if command == 'train_on':
                       # Training step
                       data_loader = self.get_dataloader(key)
-                      self.train_epoch(data_loader)
+                      self.train_epoch(data_loader, self.get_augmentation(key))
                   elif command == 'validate_on':
                       # Validation step
                       data_loader = self.get_dataloader(key)
                       self.val_epoch(data_loader, key)
+                  self.log_loader_profile(data_loader, key)
               if self.scheduler:
                   print("before step:", self.scheduler.get_last_lr())
                   self.scheduler.step()
@@ -173,26 +176,67 @@ class Engine:
           return self.dataset_cache[name]
 
       if name in self.config['datasets']:
-          ds_config = self.config['datasets'][name]
-          if 'batch_size' not in ds_config:
-              ds_config['batch_size'] = self.config['batch_size']
-          ds_config['num_workers'] = self.config['data_threads']
-          ds_config['data_sources'] = self.data_sources
-          ds_config['data_root'] = self.DATA_ROOT
-          self.dataset_cache[name] = get_loader(ds_config)
+          self.dataset_cache[name] = get_loader(self.get_dataset_config(name))
 
       return self.dataset_cache[name]
 
-  def train_epoch(self, train_loader):
+  def get_dataset_config(self, name):
+      ds_config = self.config['datasets'][name]
+      if 'batch_size' not in ds_config:
+          ds_config['batch_size'] = self.config['batch_size']
+      ds_config['num_workers'] = self.config['data_threads']
+      ds_config['data_sources'] = self.data_sources
+      ds_config['data_root'] = self.DATA_ROOT
+      return ds_config
+
+  def log_loader_profile(self, loader, name):
+      if not isinstance(loader, ProfiledLoader):
+          return
+      summary = dict(epoch=self.epoch, dataset=name, **loader.summary())
+      loader.reset()
+      self.logger.info(f'Epoch {self.epoch} - Loader profile for {name}: '
+                       f'waited {summary["wait"]["total"]:.2f}s for {summary["batches"]} batches, '
+                       f'worker stages: {summary["worker_totals"]["stages"]}')
+      self.loader_profiles.append(summary)
+      with open(self.log_dir / 'loader_profile.json', 'w') as f:
+          json.dump(self.loader_profiles, f, indent=2)
+
+  def get_augmentation(self, name):
+      ds_config = self.config['datasets'][name]
+      # D4 augmentation is done by the data loader
+      if not ds_config.get('augment') or ds_config['augment'] == 'd4':
+          return None
+      return BatchAugment(ds_config.get('augment_types'))
+
+  def to_input(self, img, loader):
+      # Loaders with deferred normalization deliver stored values, which are scaled on the device
+      scaling = getattr(loader, 'scaling', None)
+      if scaling is None:
+          return img.to(self.dev, torch.float)
+      return scaling.to(self.dev).scale(img.to(self.dev, non_blocking=True))
+
+  def train_epoch(self, train_loader, augment=None):
       self.epoch += 1
+      # Reseeds the sample order and random tile positions, identically on all ranks
+      train_loader.epoch.value = self.epoch
       wandb.log({'epoch': self.epoch}, step=self.epoch)
       self.logger.info(f'Epoch {self.epoch} - Training Started')
-      progress = tqdm(train_loader)
-      self.model.train(True)
-      for iteration, (img, target, metadata) in enumerate(progress):
-          img = img.to(self.dev, torch.float)
+      def prepare(batch):
+          img, target, metadata = batch
+          img = self.to_input(img, train_loader)
           target = target.to(self.dev, torch.long, non_blocking=True)
+          if augment is not None:
+              with loader_stage(train_loader, 'augment'):
+                  img, target = augment(img, target)
+          return img, target, metadata
 
+      if self.config.get('prefetch'):
+          batches = DevicePrefetcher(train_loader, self.dev, prepare)
+      else:
+          batches = map(prepare, train_loader)
+      progress = tqdm(batches, total=len(train_loader))
+      self.model.train(True)
+      for iteration, (img, target, metadata) in enumerate(progress):
           self.opt.zero_grad()
           y_hat = self.model(img)
 
@@ -224,6 +268,13 @@ class Engine:
 
       wandb.log({f'trn/{k}': v for k, v in metrics_vals.items()}, step=self.epoch)
 
+      chunk_cache = getattr(train_loader, 'chunk_cache', None)
+      if chunk_cache is not None:
+          cache_stats = chunk_cache.stats()
+          chunk_cache.reset_stats()
+          self.logger.info(f'Epoch {self.epoch} - Chunk cache: {cache_stats}')
+          wandb.log({'trn/chunk_cache_hit_rate': cache_stats['hit_rate']}, step=self.epoch)
+
       # Save model Checkpoint
       torch.save(self.model.state_dict(), self.checkpoints / f'{self.epoch:02d}.pt')
 
@@ -234,20 +285,29 @@ class Engine:
     val_outputs = defaultdict(list)
     self.model.train(False)
     for iteration, (raw_img, raw_target, metadata) in enumerate(tqdm(val_loader)):
-      img = raw_img.to(self.dev, torch.float)
+      img = self.to_input(raw_img, val_loader)
       target = raw_target.to(self.dev, torch.long, non_blocking=True)
       y_hat = self.model(img)
       loss = self.loss_function(y_hat, target)
       if target.min() < 255:
         self.metrics.step(y_hat, target, Loss=loss.detach())
 
-      for i in range(y_hat.shape[0]):
-        name = Path(metadata['source_file'][i]).stem
+      if 'scene' in metadata:
+        # Compact metadata from the ring buffer collate
+        names = [Path(val_loader.scene_table[s]).stem for s in metadata['scene'].tolist()]
+      else:
+        names = [Path(f).stem for f in metadata['source_file']]
+      columns = {k: v.tolist() if torch.is_tensor(v) else v for k, v in metadata.items()}
+      # Batches may live in reused ring buffer slots, so keep copies for the image logging
+      predictions = y_hat.cpu().numpy()
+      images = img.cpu().numpy().copy()
+      targets = raw_target.numpy().copy()
+      for i, name in enumerate(names):
         val_outputs[name].append({
-          'Prediction': y_hat[i].cpu().numpy(),
-          'Image': raw_img[i].numpy(),
-          'Target': raw_target[i].numpy(),
-          **{k: metadata[k][i] for k in metadata}
+          'Prediction': predictions[i],
+          'Image': images[i],
+          'Target': targets[i],
+          **{k: columns[k][i] for k in columns}
         })
 
     m = self.metrics.evaluate()